@@ -13,6 +13,7 @@ looks a bit messy as is.
 import argparse
 import config as cfg
 from segmentator import __version__
+from segmentator.cache_utils import clear_cache
 
 
 def main():
@@ -33,7 +34,14 @@ def main():
         )
     parser.add_argument(
         "--ncut",  metavar='path', required=False,
-        help="Path to nyp file with ncut labels"
+        help="Path to npz file with ncut labels (npy files of older \
+        versions are also accepted)."
+        )
+    parser.add_argument(
+        "--ncut_entry", metavar='i', required=False, type=int,
+        default=cfg.ncut_entry,
+        help="Entry of an ncut sweep archive (see --ncut_prepare) that is \
+        opened with --ncut."
         )
     parser.add_argument(
         "--scale", metavar=str(cfg.scale), required=False, type=float,
@@ -50,6 +58,11 @@ def main():
         default=cfg.perc_max,
         help="Maximum percentile used in truncation."
         )
+    parser.add_argument(
+        "--percapprox", action='store_true',
+        help="Use approximate percentiles (within 1/65536 of the data range) \
+        for truncation. Faster and uses less memory on big volumes."
+        )
     parser.add_argument(
         "--cbar_max",  metavar=str(cfg.cbar_max), required=False,  type=float,
         default=cfg.cbar_max,
@@ -73,6 +86,50 @@ def main():
         "--export_gramag", action='store_true',
         help="Export the gradient magnitude image. Not used by default."
         )
+    parser.add_argument(
+        "--gzip_level", metavar=str(cfg.gzip_level), required=False,
+        type=int, default=cfg.gzip_level, choices=range(10),
+        help="Compression level (1-9) of exported nifti files. 0 saves \
+        uncompressed .nii files, which is fastest."
+        )
+    parser.add_argument(
+        "--nr_threads", metavar=str(cfg.nr_threads), required=False,
+        type=int, default=cfg.nr_threads,
+        help="Number of threads used in heavy computations."
+        )
+    parser.add_argument(
+        "--chunk_size", metavar=str(cfg.chunk_size), required=False,
+        type=int, default=cfg.chunk_size,
+        help="Number of slices processed at once, for volumes larger than \
+        memory. Intermediate images are kept in memory-mapped scratch files. \
+        0 (default) loads the whole volume into memory."
+        )
+    parser.add_argument(
+        "--scratch_dir", metavar='path', required=False,
+        default=cfg.scratch_dir,
+        help="Directory for scratch files used with --chunk_size. System \
+        temporary directory is used by default."
+        )
+    parser.add_argument(
+        "--no_cache", action='store_true',
+        help="Do not read or write the cache of preprocessed images and \
+        histograms."
+        )
+    parser.add_argument(
+        "--clear_cache", action='store_true',
+        help="Remove all cached preprocessed images and histograms."
+        )
+    parser.add_argument(
+        "--cache_dir", metavar=str(cfg.cache_dir), required=False,
+        default=cfg.cache_dir,
+        help="Directory of the cache of preprocessed images and histograms."
+        )
+    parser.add_argument(
+        "--cache_size", metavar=str(cfg.cache_size), required=False,
+        type=float, default=cfg.cache_size,
+        help="Maximum size of the cache in gigabytes. Least recently used \
+        entries are removed first."
+        )
 
     # used in ncut preparation  (TODO: not yet tested after restructuring.)
     parser.add_argument(
@@ -85,24 +142,37 @@ def main():
         help="Figures are presented (useful for debugging)."
         )
     parser.add_argument(
-        "--ncut_maxRec", required=False, type=int,
-        default=cfg.max_rec, metavar=cfg.max_rec,
-        help="Maximum number of recursions."
+        "--ncut_maxRec", required=False, type=int, nargs='+',
+        default=[cfg.max_rec], metavar=cfg.max_rec,
+        help="Maximum number of recursions. Several values can be given \
+        to sweep over a parameter grid."
         )
     parser.add_argument(
-        "--ncut_nrSupPix", required=False, type=int,
-        default=cfg.nr_sup_pix, metavar=cfg.nr_sup_pix,
-        help="Number of regions/superpixels."
+        "--ncut_nrSupPix", required=False, type=int, nargs='+',
+        default=[cfg.nr_sup_pix], metavar=cfg.nr_sup_pix,
+        help="Number of regions/superpixels. Several values can be given \
+        to sweep over a parameter grid."
         )
     parser.add_argument(
-        "--ncut_compactness", required=False, type=float,
-        default=cfg.compactness, metavar=cfg.compactness,
+        "--ncut_compactness", required=False, type=float, nargs='+',
+        default=[cfg.compactness], metavar=cfg.compactness,
         help="Compactness balances intensity proximity and space \
         proximity of the superpixels. \
         Higher values give more weight to space proximity, making \
         superpixel shapes more square/cubic. This parameter \
         depends strongly on image contrast and on the shapes of \
-        objects in the image."
+        objects in the image. Several values can be given to sweep \
+        over a parameter grid. All combinations are computed in \
+        parallel using --nr_threads processes and saved into one \
+        npz archive."
+        )
+    parser.add_argument(
+        "--ncut_edgeSigma", required=False, type=float,
+        default=cfg.edge_sigma, metavar=cfg.edge_sigma,
+        help="Scale of the squared log count differences in the edge \
+        weights of the superpixel graph, exp(-diff**2 / sigma). The \
+        default weights all edges almost equally, smaller values \
+        (e.g. 1) make the cuts follow the histogram counts more closely."
         )
 
     # set cfg file variables to be accessed from other scripts
@@ -114,23 +184,37 @@ def main():
     cfg.scale = args.scale
     cfg.perc_min = args.percmin
     cfg.perc_max = args.percmax
+    cfg.perc_approx = args.percapprox
     cfg.cbar_max = args.cbar_max
     cfg.cbar_init = args.cbar_init
     if args.include_zeros:
         cfg.discard_zeros = False
     cfg.export_gramag = args.export_gramag
+    cfg.gzip_level = args.gzip_level
+    cfg.nr_threads = args.nr_threads
+    cfg.chunk_size = args.chunk_size
+    cfg.scratch_dir = args.scratch_dir
+    cfg.use_cache = not args.no_cache
+    cfg.cache_dir = args.cache_dir
+    cfg.cache_size = args.cache_size
     # used in ncut preparation
     cfg.ncut_figs = args.ncut_figs
     cfg.max_rec = args.ncut_maxRec
     cfg.nr_sup_pix = args.ncut_nrSupPix
     cfg.compactness = args.ncut_compactness
+    cfg.edge_sigma = args.ncut_edgeSigma
     # used in ncut
     cfg.ncut = args.ncut
+    cfg.ncut_entry = args.ncut_entry
 
     welcome_str = 'Segmentator ' + __version__
     welcome_decoration = '=' * len(welcome_str)
     print(welcome_decoration + '\n' + welcome_str + '\n' + welcome_decoration)
 
+    if args.clear_cache:
+        print('--Clearing cache at ' + cfg.cache_dir)
+        clear_cache()
+
     # Call other scripts with import method (couldn't find a better way).
     if args.nogui:
         print('--No GUI option is selected. Saving 2D histogram image...')
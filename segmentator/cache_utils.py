@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Persistent on-disk cache for preprocessed images and 2D histograms."""
+
+# Part of the Segmentator library
+# Copyright (C) 2016  Omer Faruk Gulban and Marian Schneider
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import config as cfg
+
+# bump when the layout or the meaning of the cached arrays changes
+CACHE_VERSION = 2
+
+
+def hash_file(filename, block_size=2**20):
+    """Hash the content of a file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to a file.
+    block_size : int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    digest : string
+        Hexadecimal sha1 digest of the file content.
+
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def create_cache_key(filename, **params):
+    """Create a content addressed key for an input file and parameters.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the input image.
+    **params
+        Parameters that change the cached products. String values that are
+        paths to existing files (e.g. a gradient magnitude nifti) are
+        replaced by the hash of their content.
+
+    Returns
+    -------
+    key : string
+        Hexadecimal sha1 digest.
+
+    """
+    sha = hashlib.sha1()
+    sha.update(('v' + str(CACHE_VERSION)).encode())
+    sha.update(hash_file(filename).encode())
+    for name in sorted(params):
+        value = params[name]
+        if isinstance(value, str) and os.path.isfile(value):
+            value = hash_file(value)
+        sha.update((name + '=' + repr(value) + ';').encode())
+    return sha.hexdigest()
+
+
+def create_config_cache_key():
+    """Create the cache key of the current command line parameters."""
+    return create_cache_key(cfg.filename, perc_min=cfg.perc_min,
+                            perc_max=cfg.perc_max,
+                            perc_approx=cfg.perc_approx, scale=cfg.scale,
+                            gramag=cfg.gramag,
+                            discard_zeros=cfg.discard_zeros)
+
+
+def is_cache_key(name):
+    """Check whether a directory name is a cache key."""
+    return len(name) == 40 and all(c in '0123456789abcdef' for c in name)
+
+
+def get_cache_dir(cache_dir=None):
+    """Return the cache directory, falling back to the config setting."""
+    if cache_dir is None:
+        cache_dir = cfg.cache_dir
+    return os.path.expanduser(cache_dir)
+
+
+def load_cache(key, names, cache_dir=None):
+    """Load cached arrays as read-only memory maps.
+
+    Parameters
+    ----------
+    key : string
+        Cache key, see `create_cache_key`.
+    names : list of strings
+        Names of the arrays to load.
+    cache_dir : string
+        Cache directory. `cfg.cache_dir` is used by default.
+
+    Returns
+    -------
+    arrays : list of np.memmap or None
+        Cached arrays in the order of names. None if the entry is missing
+        or incomplete.
+
+    """
+    entry = os.path.join(get_cache_dir(cache_dir), key)
+    paths = [os.path.join(entry, name + '.npy') for name in names]
+    if not all(os.path.isfile(path) for path in paths):
+        return None
+    # mark the entry as recently used
+    os.utime(entry, None)
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+
+def save_cache(key, arrays, cache_dir=None, max_size=None):
+    """Save arrays into the cache and evict least recently used entries.
+
+    Parameters
+    ----------
+    key : string
+        Cache key, see `create_cache_key`.
+    arrays : dict
+        Arrays to cache, keyed by name.
+    cache_dir : string
+        Cache directory. `cfg.cache_dir` is used by default.
+    max_size : float
+        Maximum cache size in gigabytes. `cfg.cache_size` is used by default.
+
+    Returns
+    -------
+    saved : bool
+        False if the arrays alone do not fit into the cache.
+
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if max_size is None:
+        max_size = cfg.cache_size
+    max_bytes = int(max_size * 2**30)
+    if sum(np.asarray(arr).nbytes for arr in arrays.values()) > max_bytes:
+        return False
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary directory first so that readers never see a
+    # partially written entry
+    tmp_entry = tempfile.mkdtemp(prefix='.tmp_', dir=cache_dir)
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_entry, name + '.npy'), arr)
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp_entry, entry)
+    finally:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    evict_cache(max_bytes, cache_dir=cache_dir, keep=key)
+    return True
+
+
+def evict_cache(max_bytes, cache_dir=None, keep=None):
+    """Remove least recently used entries until the cache fits in max_bytes.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum total size of the cache entries in bytes.
+    cache_dir : string
+        Cache directory. `cfg.cache_dir` is used by default.
+    keep : string
+        Key of an entry that is never removed.
+
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if not is_cache_key(key) or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f))
+                   for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, key))
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+
+
+def clear_cache(cache_dir=None):
+    """Remove all cache entries.
+
+    Only entry directories are removed, never the cache directory itself or
+    unrelated files in it.
+
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    if not os.path.isdir(cache_dir):
+        return
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry) and (is_cache_key(key)
+                                     or key.startswith('.tmp_')):
+            shutil.rmtree(entry, ignore_errors=True)
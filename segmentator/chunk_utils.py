@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+"""Out-of-core (chunked) processing for volumes larger than memory."""
+
+# Part of the Segmentator library
+# Copyright (C) 2016  Omer Faruk Gulban and Marian Schneider
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+import os
+import atexit
+import shutil
+import tempfile
+import numpy as np
+import config as cfg
+from multiprocessing.pool import ThreadPool
+from nibabel import load
+from segmentator.utils import map_ima_to_2D_hist, map_2D_hist_to_ima
+from segmentator.utils import get_bin_index_dtype
+from segmentator.utils import compute_2D_hist_counts, gradient_magnitude_slab
+from segmentator.utils import approx_percentile, get_zero_mask
+
+
+def create_scratch_dir(parent=None):
+    """Create a temporary directory which is removed at exit.
+
+    Parameters
+    ----------
+    parent : string
+        Directory in which the scratch directory is created. System default
+        temporary directory is used if None.
+
+    Returns
+    -------
+    scratch_dir : string
+        Path to the scratch directory.
+
+    """
+    scratch_dir = tempfile.mkdtemp(prefix='segmentator_', dir=parent)
+    atexit.register(shutil.rmtree, scratch_dir, True)
+    return scratch_dir
+
+
+def create_scratch_array(scratch_dir, name, shape, dtype=np.float32):
+    """Create a memory-mapped array in the scratch directory.
+
+    Parameters
+    ----------
+    scratch_dir : string
+        Path to the scratch directory.
+    name : string
+        File name (without extension).
+    shape : tuple
+        Shape of the array.
+    dtype : numpy dtype
+        Data type of the array.
+
+    Returns
+    -------
+    data : np.memmap
+        Memory-mapped array, stored as a .npy file.
+
+    """
+    path = os.path.join(scratch_dir, name + '.npy')
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                     shape=tuple(shape))
+
+
+def iter_slabs(nr_slices, chunk_size):
+    """Yield first and last (exclusive) slice indices of slabs.
+
+    Parameters
+    ----------
+    nr_slices : integer
+        Number of slices along the last axis.
+    chunk_size : integer
+        Number of slices in one slab.
+
+    """
+    for z0 in range(0, nr_slices, chunk_size):
+        yield z0, min(z0 + chunk_size, nr_slices)
+
+
+def iter_valid_values(data, chunk_size, discard_zeros=True):
+    """Yield non-nan (and optionally non-zero) values slab by slab.
+
+    Parameters
+    ----------
+    data : np.ndarray or np.memmap
+        Image data.
+    chunk_size : integer
+        Number of slices in one slab.
+    discard_zeros : bool
+        Discard voxels with value 0.
+
+    """
+    for z0, z1 in iter_slabs(data.shape[-1], chunk_size):
+        block = np.asarray(data[..., z0:z1]).ravel()
+        valid = ~np.isnan(block)
+        if discard_zeros:
+            valid &= ~get_zero_mask(block)
+        yield block[valid]
+
+
+def chunked_range(data, chunk_size, discard_zeros=True):
+    """Find minimum and maximum of valid values slab by slab.
+
+    Returns
+    -------
+    d_min, d_max : float
+        Minimum and maximum values, ignoring nans (and zeros).
+
+    """
+    d_min, d_max = np.inf, -np.inf
+    for values in iter_valid_values(data, chunk_size, discard_zeros):
+        if values.size > 0:
+            d_min = min(d_min, np.min(values))
+            d_max = max(d_max, np.max(values))
+    return d_min, d_max
+
+
+def chunked_percentile(data, percentiles, chunk_size, discard_zeros=True,
+                       nr_hist_bins=2**16, max_collect=2**20):
+    """Compute exact percentiles without loading the whole data.
+
+    Parameters
+    ----------
+    data : np.ndarray or np.memmap
+        Image data.
+    percentiles : list
+        Percentiles in range [0, 100].
+    chunk_size : integer
+        Number of slices in one slab.
+    discard_zeros : bool
+        Discard voxels with value 0.
+    nr_hist_bins : integer
+        Number of histogram bins used to narrow down the range of each rank.
+    max_collect : integer
+        Values of a rank's range are collected and sorted once there are fewer
+        than this many.
+
+    Returns
+    -------
+    values : list
+        Percentile values, same as np.nanpercentile with linear interpolation.
+
+    Notes
+    -----
+    The ranks that are needed for the percentiles are searched for with
+    histograms over narrowing ranges. Each pass streams the data once, and
+    memory does not depend on the data size.
+
+    """
+    nr_values = 0
+    for values in iter_valid_values(data, chunk_size, discard_zeros):
+        nr_values += values.size
+    d_min, d_max = chunked_range(data, chunk_size, discard_zeros)
+    positions = np.asarray(percentiles, dtype=float) / 100 * (nr_values - 1)
+    ranks = set(np.floor(positions).astype(int)) | set(
+        np.ceil(positions).astype(int))
+
+    # per rank: range low, range high, range is right closed, nr values
+    # below the range and nr values in the range
+    state = {r: [d_min, d_max, True, 0, nr_values] for r in ranks}
+    found = {}
+    while len(found) < len(ranks):
+        hists, extrema, collect = {}, {}, {}
+        for r in ranks:
+            if r in found:
+                continue
+            elif state[r][4] <= max_collect:
+                collect[r] = []
+            else:
+                hists[r] = np.zeros(nr_hist_bins, dtype=np.int64)
+                extrema[r] = [np.inf, -np.inf]
+        for values in iter_valid_values(data, chunk_size, discard_zeros):
+            for r in list(hists) + list(collect):
+                lo, hi, closed = state[r][:3]
+                if closed:
+                    sel = values[(values >= lo) & (values <= hi)]
+                else:
+                    sel = values[(values >= lo) & (values < hi)]
+                if r in collect:
+                    collect[r].append(sel)
+                elif sel.size > 0:
+                    hists[r] += np.histogram(sel, bins=nr_hist_bins,
+                                             range=(lo, hi))[0]
+                    extrema[r][0] = min(extrema[r][0], np.min(sel))
+                    extrema[r][1] = max(extrema[r][1], np.max(sel))
+        for r in collect:
+            values = np.sort(np.concatenate(collect[r]))
+            found[r] = values[r - state[r][3]]
+        for r in hists:
+            lo, hi, closed, below, _ = state[r]
+            if extrema[r][0] == extrema[r][1]:  # all values are the same
+                found[r] = extrema[r][0]
+                continue
+            edges = np.linspace(lo, hi, nr_hist_bins + 1)
+            cumsum = np.cumsum(hists[r])
+            b = int(np.searchsorted(cumsum, r - below, side='right'))
+            b = min(b, nr_hist_bins - 1)
+            state[r] = [edges[b], edges[b+1],
+                        closed and b == nr_hist_bins - 1,
+                        below + cumsum[b] - hists[r][b], hists[r][b]]
+
+    output = []
+    for p in positions:
+        lower, upper = found[int(np.floor(p))], found[int(np.ceil(p))]
+        output.append(lower + (upper - lower) * (p - np.floor(p)))
+    return output
+
+
+def load_nifti_chunked(nii, scratch_dir, name, chunk_size):
+    """Copy nifti data into a float32 scratch array slab by slab.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Loaded nifti image. Data is read through its array proxy.
+    scratch_dir : string
+        Path to the scratch directory.
+    name : string
+        Name of the scratch file.
+    chunk_size : integer
+        Number of slices in one slab.
+
+    Returns
+    -------
+    data : np.memmap
+        Squeezed image data.
+
+    """
+    dims = tuple(d for d in nii.shape if d != 1)  # same as np.squeeze
+    data = create_scratch_array(scratch_dir, name, dims)
+    for z0, z1 in iter_slabs(dims[-1], chunk_size):
+        slab = np.asarray(nii.dataobj[:, :, z0:z1], dtype=np.float32)
+        data[..., z0:z1] = slab.reshape(dims[:-1] + (z1 - z0,))
+    return data
+
+
+def truncate_range_chunked(data, chunk_size, percMin=0.25, percMax=99.75,
+                           discard_zeros=True, approx=False):
+    """Truncate too low and too high values in place, slab by slab.
+
+    See utils.truncate_range for parameters and returns.
+
+    """
+    if approx:  # two passes instead of several
+        pMin, pMax = approx_percentile(data, [percMin, percMax],
+                                       discard_zeros=discard_zeros)
+    else:
+        pMin, pMax = chunked_percentile(data, [percMin, percMax], chunk_size,
+                                        discard_zeros=discard_zeros)
+    for z0, z1 in iter_slabs(data.shape[-1], chunk_size):
+        block = data[..., z0:z1]
+        if discard_zeros:
+            zeros = get_zero_mask(block)
+        np.clip(block, pMin, pMax, out=block)
+        if discard_zeros:
+            np.copyto(block, 0, where=zeros)  # put back masked out voxels
+    return data, pMin, pMax
+
+
+def scale_range_chunked(data, chunk_size, scale_factor=500, delta=0,
+                        discard_zeros=True):
+    """Scale values in place, slab by slab.
+
+    See utils.scale_range for parameters and returns.
+
+    """
+    d_min, d_max = chunked_range(data, chunk_size, discard_zeros)
+    scale_factor = (scale_factor - delta) / (d_max - d_min)
+    for z0, z1 in iter_slabs(data.shape[-1], chunk_size):
+        block = data[..., z0:z1]
+        if discard_zeros:
+            zeros = get_zero_mask(block)
+        block -= d_min
+        block *= scale_factor
+        if discard_zeros:
+            np.copyto(block, 0, where=zeros)  # put back masked out voxels
+    return data
+
+
+def compute_gradient_magnitude_chunked(ima, gra_mag, chunk_size,
+                                       method='scharr', nr_threads=1):
+    """Compute gradient magnitude slab by slab.
+
+    Parameters
+    ----------
+    ima : np.ndarray or np.memmap
+        First image, which is often the intensity image (eg. T1w).
+    gra_mag : np.memmap, float32
+        Output gradient magnitude image.
+    chunk_size : integer
+        Number of slices in one slab.
+    method : string
+        Gradient computation method (see utils.compute_gradient_magnitude).
+    nr_threads : integer
+        Number of slabs that are processed concurrently.
+
+    """
+    def compute_slab(slab):
+        gradient_magnitude_slab(ima, gra_mag, slab, method=method.lower())
+
+    slabs = iter_slabs(ima.shape[-1], chunk_size)
+    if nr_threads > 1:
+        pool = ThreadPool(nr_threads)
+        for _ in pool.imap_unordered(compute_slab, slabs):
+            pass
+        pool.close()
+        pool.join()
+    else:
+        for slab in slabs:
+            compute_slab(slab)
+    return gra_mag
+
+
+def preprocess_chunked(nii, scratch_dir, chunk_size, nr_threads=1):
+    """Truncate, scale and compute gradient magnitude out-of-core.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Loaded nifti image.
+    scratch_dir : string
+        Path to the scratch directory where intermediates are stored.
+    chunk_size : integer
+        Number of slices in one slab.
+    nr_threads : integer
+        Number of threads used for gradient magnitude computation.
+
+    Returns
+    -------
+    orig : np.memmap
+        Truncated and scaled image.
+    gra : np.memmap
+        Gradient magnitude image.
+    pMin, pMax : float
+        Minimum and maximum truncation thresholds.
+
+    Notes
+    -----
+    Uses command line arguments stored in config.
+
+    """
+    orig = load_nifti_chunked(nii, scratch_dir, 'orig', chunk_size)
+    orig, pMin, pMax = truncate_range_chunked(
+        orig, chunk_size, percMin=cfg.perc_min, percMax=cfg.perc_max,
+        approx=cfg.perc_approx)
+    orig = scale_range_chunked(orig, chunk_size, scale_factor=cfg.scale,
+                               delta=0.0001)
+    if cfg.gramag not in cfg.gramag_options:
+        gra = load_nifti_chunked(load(cfg.gramag), scratch_dir, 'gra',
+                                 chunk_size)
+        gra, _, _ = truncate_range_chunked(
+            gra, chunk_size, percMin=cfg.perc_min, percMax=cfg.perc_max,
+            approx=cfg.perc_approx)
+        gra = scale_range_chunked(gra, chunk_size, scale_factor=cfg.scale,
+                                  delta=0.0001)
+    else:
+        gra = create_scratch_array(scratch_dir, 'gra', orig.shape)
+        gra = compute_gradient_magnitude_chunked(
+            orig, gra, chunk_size, method=cfg.gramag, nr_threads=nr_threads)
+    return orig, gra, pMin, pMax
+
+
+def prep_2D_hist_chunked(ima, gra, scratch_dir, chunk_size,
+                         discard_zeros=True, nr_threads=1):
+    """Prepare 2D histogram related variables slab by slab.
+
+    Parameters
+    ----------
+    ima : np.ndarray or np.memmap
+        First image, which is often the intensity image (eg. T1w).
+    gra : np.ndarray or np.memmap
+        Second image, which is often the gradient magnitude image.
+    scratch_dir : string
+        Directory of the scratch file of the voxel to pixel mapping.
+    chunk_size : integer
+        Number of slices in one slab.
+    discard_zeros : bool
+        Discard voxels with value 0 from the histogram counts.
+    nr_threads : integer
+        Number of threads used to count the histogram.
+
+    Returns
+    -------
+    See utils.prep_2D_hist.
+
+    """
+    d_min, d_max = np.round(chunked_range(ima, chunk_size, discard_zeros))
+    nr_bins = int(d_max - d_min)
+    bin_edges = np.arange(d_min, d_max+1)
+    counts = np.zeros((nr_bins, nr_bins), dtype=np.int64)
+    vox2pixMap = create_scratch_array(scratch_dir, 'invHistVolume', ima.shape,
+                                      dtype=get_bin_index_dtype(nr_bins))
+    for z0, z1 in iter_slabs(ima.shape[-1], chunk_size):
+        block = np.asarray(ima[..., z0:z1])
+        block_map = map_ima_to_2D_hist(block, gra[..., z0:z1], bin_edges)
+        if discard_zeros:  # zeros are mapped outside of the histogram
+            np.copyto(block_map, nr_bins*nr_bins, where=get_zero_mask(block))
+        counts += compute_2D_hist_counts(block_map, nr_bins,
+                                         nr_threads=nr_threads)
+        vox2pixMap[..., z0:z1] = block_map
+    return counts, d_min, d_max, nr_bins, bin_edges, vox2pixMap
+
+
+def map_2D_hist_to_ima_chunked(vox2pixMap, volHistMask, labels, chunk_size,
+                               discard_zeros=False):
+    """Volume histogram to image mapping, slab by slab.
+
+    Parameters
+    ----------
+    vox2pixMap : np.ndarray or np.memmap
+        Voxel to pixel mapping.
+    volHistMask : 2D numpy array
+        Volume histogram mask.
+    labels : np.ndarray or np.memmap
+        Output labels, same shape as vox2pixMap.
+    chunk_size : integer
+        Number of slices in one slab.
+    discard_zeros : bool
+        Do not label voxels that fall into the first histogram bin.
+
+    """
+    for z0, z1 in iter_slabs(vox2pixMap.shape[-1], chunk_size):
+        labels[..., z0:z1] = map_2D_hist_to_ima(
+            vox2pixMap[..., z0:z1], volHistMask, discard_zeros=discard_zeros)
+    return labels
@@ -14,17 +14,39 @@ filename = 'sample_filename_here'
 gramag = 'scharr'
 perc_min = 2.5
 perc_max = 97.5
+perc_approx = False
 scale = 400
 cbar_max = 5.0
 cbar_init = 3.0
 discard_zeros = True
 export_gramag = False
+gzip_level = 1  # 0 saves uncompressed nifti files
+nr_threads = 1
+
+# out-of-core processing (0 loads the whole volume into memory)
+chunk_size = 0
+scratch_dir = None
+
+# persistent cache of preprocessed images and histograms (size in gigabytes)
+use_cache = True
+cache_dir = '~/.cache/segmentator'
+cache_size = 10.
+
+# interactive display: frame rate cap and delay (ms) of the full slice remap
+# after the last mouse or slider event
+max_fps = 30
+remap_delay = 150
+# slice masks computed ahead around the current slice and kept in memory
+prefetch_slices = 8
+slice_cache_size = 64
 
 # possible gradient magnitude computation keyword options
 gramag_options = ['scharr', 'sobel', 'prewitt', 'numpy']
 
 # used in segmentator ncut
 ncut = False
+ncut_entry = None
 max_rec = 8
 nr_sup_pix = 2500
 compactness = 2
+edge_sigma = 255.
@@ -19,10 +19,21 @@
 
 from __future__ import division
 import os
+import time
+import threading
 import numpy as np
 import matplotlib.pyplot as plt
-from utils import map_2D_hist_to_ima
-from nibabel import save, Nifti1Image
+from utils import create_2D_hist_lut
+from utils import update_labels_from_bin_index
+from utils import save_nifti, get_nifti_extension
+from chunk_utils import create_scratch_array, map_2D_hist_to_ima_chunked
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+from multiprocessing.pool import ThreadPool
+from nibabel import Nifti1Image
 import config as cfg
 
 
@@ -42,10 +53,17 @@ class responsiveObj:
         self.nrExports = 0
         self.entropWin = 0
         self.borderSwitch = 0
-        self.imaSlc = self.orig[:, :, self.sliceNr]  # selected slice
-        self.cycleCount = 0
+        self.dims = self.orig.shape
+        self.cycleCount = 0  # current view, see getSlice
+        self.activeSlice = (None, None)  # (key, contiguous mapping slice)
+        self.imaSlc = self.getSlice(self.orig, self.sliceNr)  # selected slice
         self.cycRotHistory = [[0, 0], [0, 0], [0, 0]]
         self.highlights = [[], []]  # to hold image to histogram circles
+        self.volLabels, self.volLabelsLut = None, None
+        self.initBlit()
+        self.initScheduler()
+        self.initSliceCache()
+        self.initExports()
 
     def remapMsks(self, remap_slice=True):
         """Update volume histogram to image mapping.
@@ -59,44 +77,235 @@ class responsiveObj:
         if self.segmType == 'main':
             self.volHistMask = self.sectorObj.binaryMask()
             self.volHistMask = self.lassoArr(self.volHistMask,
-                                             self.idxLasso)
+                                             self.lassoMask)
             self.volHistMaskH.set_data(self.volHistMask)
         elif self.segmType == 'ncut':
             self.labelContours()
             self.volHistMaskH.set_data(self.volHistMask)
             self.volHistMaskH.set_extent((0, self.nrBins, self.nrBins, 0))
+        self.checkMaskVersion()
         # histogram to image mapping
         if remap_slice:
-            temp_slice = self.invHistVolume[:, :, self.sliceNr]
-            image_slice_shape = self.invHistVolume[:, :, self.sliceNr].shape
-            if cfg.discard_zeros:
-                zmask = temp_slice != 0
-                image_slice_mask = map_2D_hist_to_ima(temp_slice[zmask],
-                                                      self.volHistMask)
-                # reshape to image slice shape
-                self.imaSlcMsk = np.zeros(image_slice_shape)
-                self.imaSlcMsk[zmask] = image_slice_mask
-            else:
-                image_slice_mask = map_2D_hist_to_ima(temp_slice.flatten(),
-                                                      self.volHistMask)
-                # reshape to image slice shape
-                self.imaSlcMsk = image_slice_mask.reshape(image_slice_shape)
+            self.imaSlcMsk = self.getSliceMask(self.sliceNr)
 
             # for optional border visualization
             if self.borderSwitch == 1:
                 self.imaSlcMsk = self.calcImaMaskBrd()
 
-    def updatePanels(self, update_slice=True, update_rotation=False,
-                     update_extent=False):
+    def getSlice(self, volume, sliceNr, view=None):
+        """Extract a slice of a view, without transposing the volume.
+
+        Parameters
+        ----------
+        volume : 3D numpy array
+            Volume in its original orientation (e.g. orig, invHistVolume).
+        sliceNr : int
+            Slice index along the slicing axis of the view.
+        view : int
+            0, 1 or 2 slice along the last, middle and first axis. The slices
+            are oriented like the views of the earlier cyclic (2, 0, 1)
+            transpositions of the volume. Current view is used by default.
+
+        Returns
+        -------
+        slc : 2D numpy array
+            View of the slice in volume.
+
+        """
+        if view is None:
+            view = self.cycleCount
+        if view == 0:
+            return volume[:, :, sliceNr]
+        elif view == 1:
+            return volume[:, sliceNr, :].T
+        else:
+            return volume[sliceNr, :, :]
+
+    def nrSlices(self, view=None):
+        """Return the number of slices in a view."""
+        if view is None:
+            view = self.cycleCount
+        return self.dims[2 - view]
+
+    def getActiveMapSlice(self):
+        """Return a contiguous copy of the current image to histogram slice.
+
+        Only the copy of the active slice is kept.
+
+        """
+        key = (self.cycleCount, self.sliceNr)
+        if self.activeSlice[0] != key:
+            self.activeSlice = (key, np.ascontiguousarray(
+                self.getSlice(self.invHistVolume, self.sliceNr)))
+        return self.activeSlice[1]
+
+    def initSliceCache(self):
+        """Prepare caching and background prefetching of slice masks."""
+        self.maskVersion = 0
+        self.maskSnapshot = None
+        self.sliceCache = OrderedDict()  # least recently used first
+        self.sliceCacheLock = threading.Lock()
+        self.prefetchPool = ThreadPool(1)
+
+    def checkMaskVersion(self):
+        """Bump the mask version and drop stale slices if the mask changed."""
+        if (self.maskSnapshot is not None
+                and np.array_equal(self.maskSnapshot, self.volHistMask)):
+            return
+        self.maskSnapshot = np.copy(self.volHistMask)
+        with self.sliceCacheLock:
+            self.maskVersion += 1
+            self.sliceCache.clear()
+
+    def getSliceMask(self, sliceNr):
+        """Return the label mask of a slice in the current view.
+
+        Cached slices are returned directly. Neighbouring slices of the
+        requested one are computed in the background afterwards.
+
+        """
+        key = (self.cycleCount, sliceNr, self.maskVersion)
+        with self.sliceCacheLock:
+            imaSlcMsk = self.sliceCache.pop(key, None)
+            if imaSlcMsk is not None:  # move to most recently used
+                self.sliceCache[key] = imaSlcMsk
+        lut = create_2D_hist_lut(self.maskSnapshot,
+                                 discard_zeros=cfg.discard_zeros)
+        if imaSlcMsk is None:
+            if sliceNr == self.sliceNr:
+                mapSlc = self.getActiveMapSlice()
+            else:
+                mapSlc = self.getSlice(self.invHistVolume, sliceNr)
+            imaSlcMsk = np.take(lut, mapSlc, mode='clip')
+            self.cacheSliceMask(key, imaSlcMsk)
+        self.prefetchPool.apply_async(self.prefetchSlices,
+                                      (key, self.invHistVolume, lut))
+        return imaSlcMsk
+
+    def cacheSliceMask(self, key, imaSlcMsk):
+        """Store a slice mask, unless the histogram mask changed meanwhile."""
+        with self.sliceCacheLock:
+            if key[2] != self.maskVersion:
+                return
+            self.sliceCache[key] = imaSlcMsk
+            while len(self.sliceCache) > cfg.slice_cache_size:
+                self.sliceCache.popitem(last=False)
+
+    def prefetchSlices(self, key, invHistVolume, lut):
+        """Compute masks of the slices around a slice (background thread)."""
+        view, sliceNr, version = key
+        for offset in range(1, cfg.prefetch_slices + 1):
+            for nextNr in (sliceNr + offset, sliceNr - offset):
+                # stop if the mask, view or slice changed meanwhile
+                if (version != self.maskVersion or view != self.cycleCount
+                        or sliceNr != self.sliceNr):
+                    return
+                if not 0 <= nextNr < self.nrSlices(view):
+                    continue
+                nextKey = (view, nextNr, version)
+                with self.sliceCacheLock:
+                    if nextKey in self.sliceCache:
+                        continue
+                self.cacheSliceMask(nextKey, np.take(
+                    lut, self.getSlice(invHistVolume, nextNr, view=view),
+                    mode='clip'))
+
+    def updatePanels(self, update_slice=True, update_extent=False):
         """Update histogram and image panels."""
-        if update_rotation:
-            self.checkRotation()
+        transform = self.sliceTransform()
         if update_extent:
             self.updateImaExtent()
         if update_slice:
-            self.imaSlcH.set_data(self.imaSlc)
-        self.imaSlcMskH.set_data(self.imaSlcMsk)
-        self.figure.canvas.draw()
+            self.imaSlcH.set_data(transform.displayData(self.imaSlc))
+        self.imaSlcMskH.set_data(transform.displayData(self.imaSlcMsk))
+        if update_slice or update_extent:  # static background changed
+            self.figure.canvas.draw()
+        else:
+            self.blitPanels()
+
+    def initScheduler(self):
+        """Prepare merging rapid interaction events into fewer updates."""
+        self.pendingFlags = {}
+        self.lastFrame = 0.
+        self.remapTimer = self.figure.canvas.new_timer(
+            interval=cfg.remap_delay)
+        self.remapTimer.single_shot = True
+        self.remapTimer.add_callback(self.flushUpdate)
+
+    def scheduleUpdate(self, preview=False, **flags):
+        """Merge an interaction event into the pending panel update.
+
+        Parameters
+        ----------
+        preview : bool
+            Only update the histogram mask while events keep coming and do
+            the slice remap once they stop. Otherwise remap at most at
+            `cfg.max_fps`.
+        **flags
+            Keyword arguments of `updatePanels`.
+
+        """
+        for key, value in flags.items():
+            self.pendingFlags[key] = self.pendingFlags.get(key, False) or value
+        # the timer fires the full update once the events stop
+        self.remapTimer.stop()
+        self.remapTimer.start()
+        now = time.time()
+        if now - self.lastFrame < 1. / cfg.max_fps:
+            return
+        self.lastFrame = now
+        if preview:
+            self.remapMsks(remap_slice=False)
+            self.blitPanels()
+        else:
+            self.flushUpdate()
+
+    def flushUpdate(self):
+        """Do the pending remap and panel update, if any."""
+        self.remapTimer.stop()
+        if not self.pendingFlags:
+            return
+        flags, self.pendingFlags = self.pendingFlags, {}
+        self.remapMsks()
+        self.updatePanels(**flags)
+
+    def initBlit(self):
+        """Prepare redrawing only the changing artists (blitting)."""
+        self.background = None
+        self.useBlit = getattr(self.figure.canvas, 'supports_blit', False)
+        if self.useBlit:
+            for artist in self.animatedArtists():
+                artist.set_animated(True)
+            self.cidDraw = self.figure.canvas.mpl_connect(
+                'draw_event', self.on_draw)
+
+    def animatedArtists(self):
+        """Return the artists that change during the interaction."""
+        artists = [self.volHistMaskH]
+        if self.segmType == 'ncut':
+            artists.insert(0, self.pltMapH)
+        for small, large in zip(self.highlights[0], self.highlights[1]):
+            artists += [small, large]
+        artists.append(self.imaSlcMskH)
+        return artists
+
+    def on_draw(self, event):
+        """Cache the static background after a full redraw."""
+        self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+        for artist in self.animatedArtists():
+            artist.axes.draw_artist(artist)
+
+    def blitPanels(self):
+        """Redraw the changing artists on top of the cached background."""
+        canvas = self.figure.canvas
+        if not self.useBlit or self.background is None:
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self.background)
+        for artist in self.animatedArtists():
+            artist.axes.draw_artist(artist)
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
 
     def connect(self):
         """Make the object responsive."""
@@ -126,30 +335,25 @@ class responsiveObj:
         elif event.key == '1':
             self.borderSwitch = (self.borderSwitch + 1) % 2
             self.remapMsks()
-            self.updatePanels(update_slice=False, update_rotation=False,
-                              update_extent=False)
+            self.updatePanels(update_slice=False, update_extent=False)
 
         if self.segmType == 'main':
             if event.key == 'up':
                 self.sectorObj.scale_r(1.05)
                 self.remapMsks()
-                self.updatePanels(update_slice=False, update_rotation=True,
-                                  update_extent=False)
+                self.updatePanels(update_slice=False, update_extent=False)
             elif event.key == 'down':
                 self.sectorObj.scale_r(0.95)
                 self.remapMsks()
-                self.updatePanels(update_slice=False, update_rotation=True,
-                                  update_extent=False)
+                self.updatePanels(update_slice=False, update_extent=False)
             elif event.key == 'right':
                 self.sectorObj.rotate(-10.0)
                 self.remapMsks()
-                self.updatePanels(update_slice=False, update_rotation=True,
-                                  update_extent=False)
+                self.updatePanels(update_slice=False, update_extent=False)
             elif event.key == 'left':
                 self.sectorObj.rotate(10.0)
                 self.remapMsks()
-                self.updatePanels(update_slice=False, update_rotation=True,
-                                  update_extent=False)
+                self.updatePanels(update_slice=False, update_extent=False)
             else:
                 return
 
@@ -161,22 +365,11 @@ class responsiveObj:
     def findVoxInHist(self, event):
         """Find voxel's location in histogram."""
         self.press = event.xdata, event.ydata
-        pixel_x = int(np.floor(event.xdata))
-        pixel_y = int(np.floor(event.ydata))
-        aoi = self.invHistVolume[:, :, self.sliceNr]  # array of interest
-        # Check rotation
-        cyc_rot = self.cycRotHistory[self.cycleCount][1]
-        if cyc_rot == 1:  # 90
-            aoi = np.rot90(aoi, axes=(0, 1))
-        elif cyc_rot == 2:  # 180
-            aoi = aoi[::-1, ::-1]
-        elif cyc_rot == 3:  # 270
-            aoi = np.rot90(aoi, axes=(1, 0))
-        # Switch x and y voxel to get linear index since not Cartesian!!!
-        pixelLin = aoi[pixel_y, pixel_x]
+        # map the clicked (possibly rotated) display pixel to the slice
+        row, col = self.sliceTransform().toArray(event.xdata, event.ydata)
+        pixelLin = self.getSlice(self.invHistVolume, self.sliceNr)[row, col]
         # ind2sub
-        xpix = (pixelLin / self.nrBins)
-        ypix = (pixelLin % self.nrBins)
+        xpix, ypix = divmod(int(pixelLin), self.nrBins)
         # Switch x and y for circle centre since back to Cartesian.
         circle_colors = [np.array([8, 48, 107, 255])/255,
                          np.array([33, 113, 181, 255])/255]
@@ -186,7 +379,9 @@ class responsiveObj:
                                   edgecolor=None, color=circle_colors[1]))
         self.axes.add_artist(self.highlights[0][-1])  # small circle
         self.axes.add_artist(self.highlights[1][-1])  # large circle
-        self.figure.canvas.draw()
+        self.highlights[0][-1].set_animated(self.useBlit)
+        self.highlights[1][-1].set_animated(self.useBlit)
+        self.blitPanels()
 
     def on_press(self, event):
         """Determine what happens if mouse button is clicked."""
@@ -215,13 +410,11 @@ class responsiveObj:
                 if self.ctrlHeld is False:  # ctrl no
                     self.sectorObj.scale_r(1.05)
                     self.remapMsks()
-                    self.updatePanels(update_slice=False, update_rotation=True,
-                                      update_extent=False)
+                    self.updatePanels(update_slice=False, update_extent=False)
                 elif self.ctrlHeld is True:  # ctrl yes
                     self.sectorObj.rotate(10.0)
                     self.remapMsks()
-                    self.updatePanels(update_slice=False, update_rotation=True,
-                                      update_extent=False)
+                    self.updatePanels(update_slice=False, update_extent=False)
                 else:
                     return
             elif event.button == 3:  # right button
@@ -231,13 +424,11 @@ class responsiveObj:
                 if self.ctrlHeld is False:  # ctrl no
                     self.sectorObj.scale_r(0.95)
                     self.remapMsks()
-                    self.updatePanels(update_slice=False, update_rotation=True,
-                                      update_extent=False)
+                    self.updatePanels(update_slice=False, update_extent=False)
                 elif self.ctrlHeld is True:  # ctrl yes
                     self.sectorObj.rotate(-10.0)
                     self.remapMsks()
-                    self.updatePanels(update_slice=False, update_rotation=True,
-                                      update_extent=False)
+                    self.updatePanels(update_slice=False, update_extent=False)
                 else:
                     return
         elif self.segmType == 'ncut':
@@ -249,22 +440,20 @@ class responsiveObj:
                     # increment counterField for values in clicked subfield, at
                     # the first click the entire field constitutes the subfield
                     counter = int(self.counterField[ybin][xbin])
-                    if counter+1 >= self.ima_ncut_labels.shape[2]:
+                    if counter+1 >= self.ncut_labels.nrLevels:
                         print("already at maximum ncut dimension")
                         return
-                    self.counterField[(
-                        self.ima_ncut_labels[:, :, counter] ==
-                        self.ima_ncut_labels[[ybin], [xbin], counter])] += 1
-                    print("counter:" + str(counter+1))
                     # define arrays with old and new labels for later indexing
-                    oLabels = self.ima_ncut_labels[:, :, counter]
-                    nLabels = self.ima_ncut_labels[:, :, counter+1]
+                    oLabels = self.getNcutLevel(counter)
+                    nLabels = self.getNcutLevel(counter+1)
+                    self.counterField[
+                        oLabels == oLabels[ybin, xbin]] += 1
+                    print("counter:" + str(counter+1))
                     # replace old values with new values (in clicked subfield)
                     self.volHistMask[oLabels == val] = np.copy(
                         nLabels[oLabels == val])
                     self.remapMsks()
-                    self.updatePanels(update_slice=False, update_rotation=True,
-                                      update_extent=False)
+                    self.updatePanels(update_slice=False, update_extent=False)
 
                 elif event.inaxes == self.axes2:  # cursor in right plot (brow)
                     self.findVoxInHist(event)
@@ -279,8 +468,7 @@ class responsiveObj:
                     self.volHistMask[self.volHistMask == val] = \
                         np.copy(self.labelNr)
                     self.remapMsks()
-                    self.updatePanels(update_slice=False, update_rotation=True,
-                                      update_extent=False)
+                    self.updatePanels(update_slice=False, update_extent=False)
 
     def on_motion(self, event):
         """Determine what happens if mouse button moves."""
@@ -304,19 +492,19 @@ class responsiveObj:
             self.sectorObj.set_x(x0 + dx)
             self.sectorObj.set_y(y0 + dy)
             # update masks
-            self.remapMsks()
-            self.updatePanels(update_slice=False, update_rotation=True,
-                              update_extent=False)
+            self.scheduleUpdate(preview=True, update_slice=False,
+                                update_extent=False)
         else:
             return
 
     def on_release(self, event):
         """Determine what happens if mouse button is released."""
         self.press = None
+        self.flushUpdate()  # finish the remap of a sector drag
         # Remove highlight circle
         if self.highlights[1]:
             self.highlights[1][-1].set_visible(False)
-        self.figure.canvas.draw()
+        self.blitPanels()
 
     def disconnect(self):
         """Make the object unresponsive."""
@@ -327,101 +515,180 @@ class responsiveObj:
     def updateColorBar(self, val):
         """Update slider for scaling log colorbar in 2D hist."""
         histVMax = np.power(10, self.sHistC.val)
-        plt.clim(vmax=histVMax)
+        self.volHistH.set_clim(vmax=histVMax)
 
     def updateSliceNr(self):
         """Update slice number and the selected slice."""
-        self.sliceNr = int(self.sSliceNr.val*self.orig.shape[2])
-        self.imaSlc = self.orig[:, :, self.sliceNr]
+        self.sliceNr = int(self.sSliceNr.val*self.nrSlices())
+        self.imaSlc = self.getSlice(self.orig, self.sliceNr)
 
     def updateImaBrowser(self, val):
         """Update image browse."""
         # scale slider value [0,1) to dimension index
         self.updateSliceNr()
-        self.remapMsks()
-        self.updatePanels(update_slice=True, update_rotation=True,
-                          update_extent=True)
+        self.scheduleUpdate(update_slice=True, update_extent=True)
+
+    def getNcutLevel(self, level):
+        """Expand the ncut labels of one level, (y, x) histogram layout."""
+        return self.ncut_labels.level(level).T
+
+    def sliceTransform(self):
+        """Return the display transform of slices in the current view."""
+        return sliceTransform(self.imaSlc.shape,
+                              self.cycRotHistory[self.cycleCount][1])
 
     def updateImaExtent(self):
         """Update both image and mask extent in image browser."""
-        self.imaSlcH.set_extent((0, self.imaSlc.shape[1],
-                                 self.imaSlc.shape[0], 0))
-        self.imaSlcMskH.set_extent((0, self.imaSlc.shape[1],
-                                    self.imaSlc.shape[0], 0))
+        transform = self.sliceTransform()
+        self.imaSlcH.set_extent(transform.extent())
+        self.imaSlcMskH.set_extent(transform.extent())
+        # fix the axis directions, flips are done by the extent only
+        height, width = transform.displayShape()
+        self.axes2.set_xlim(0, width)
+        self.axes2.set_ylim(height, 0)
 
     def cycleView(self, event):
         """Cycle through views."""
         self.cycleCount = (self.cycleCount + 1) % 3
-        # transpose data
-        self.orig = np.transpose(self.orig, (2, 0, 1))
-        # transpose ima2volHistMap
-        self.invHistVolume = np.transpose(self.invHistVolume, (2, 0, 1))
-        # updates
+        # updates, slices are taken along the axis of the new view
         self.updateSliceNr()
         self.remapMsks()
-        self.updatePanels(update_slice=True, update_rotation=True,
-                          update_extent=True)
-
-    def rotateIma90(self, axes=(0, 1)):
-        """Rotate image slice 90 degrees."""
-        self.imaSlc = np.rot90(self.imaSlc, axes=axes)
-        self.imaSlcMsk = np.rot90(self.imaSlcMsk, axes=axes)
+        self.updatePanels(update_slice=True, update_extent=True)
 
     def changeRotation(self, event):
         """Change rotation of image after clicking the button."""
         self.cycRotHistory[self.cycleCount][1] += 1
         self.cycRotHistory[self.cycleCount][1] %= 4
-        self.rotateIma90()
-        self.updatePanels(update_slice=True, update_rotation=False,
-                          update_extent=True)
-
-    def checkRotation(self):
-        """Check rotation update if changed."""
-        cyc_rot = self.cycRotHistory[self.cycleCount][1]
-        if cyc_rot == 1:  # 90
-            self.rotateIma90(axes=(0, 1))
-        elif cyc_rot == 2:  # 180
-            self.imaSlc = self.imaSlc[::-1, ::-1]
-            self.imaSlcMsk = self.imaSlcMsk[::-1, ::-1]
-        elif cyc_rot == 3:  # 270
-            self.rotateIma90(axes=(1, 0))
+        self.updatePanels(update_slice=True, update_extent=True)
+
+    def initExports(self):
+        """Prepare exporting labels in a background thread."""
+        self.exportPool = ThreadPool(1)  # one export at a time, others wait
+        self.exportMessages = queue.Queue()  # from the export thread
+        self.exportFiles = []  # queued and running exports
+        self.exportStatus = ''
+        self.exportTimer = self.figure.canvas.new_timer(interval=200)
+        self.exportTimer.add_callback(self.pollExports)
 
     def exportNifti(self, event):
         """Export labels in the image browser as a nifti file."""
-        print("Start exporting labels...")
-        # put the permuted indices back to their original format
-        cycBackPerm = (self.cycleCount, (self.cycleCount+1) % 3,
-                       (self.cycleCount+2) % 3)
         # assing unique integers (for ncut labels)
-        out_volHistMask = np.copy(self.volHistMask)
-        labels = np.unique(self.volHistMask)
-        intLabels = [i for i in range(labels.size)]
-        for label, newLabel in zip(labels, intLabels):
-            out_volHistMask[out_volHistMask == label] = intLabels[newLabel]
-        # get 3D brain mask
-        volume_image = np.transpose(self.invHistVolume, cycBackPerm)
-        if cfg.discard_zeros:
-            zmask = volume_image != 0
-            temp_labeled_image = map_2D_hist_to_ima(volume_image[zmask],
-                                                    out_volHistMask)
-            out_nii = np.zeros(volume_image.shape)
-            out_nii[zmask] = temp_labeled_image  # put back flat labels
-        else:
-            out_nii = map_2D_hist_to_ima(volume_image.flatten(),
-                                         out_volHistMask)
-            out_nii = out_nii.reshape(volume_image.shape)
-        # save mask image as nii
-        new_image = Nifti1Image(out_nii, header=self.nii.get_header(),
-                                affine=self.nii.get_affine())
-        # get new flex file name and check for overwriting
+        _, out_volHistMask = np.unique(self.volHistMask, return_inverse=True)
+        out_volHistMask = out_volHistMask.reshape(self.volHistMask.shape)
+        self.queueExport(out_volHistMask, callback=self.exportDone)
+
+    def queueExport(self, volHistMask, callback=None):
+        """Queue labeling and saving the volume in a background thread.
+
+        Parameters
+        ----------
+        volHistMask : 2D numpy array
+            Snapshot of the volume histogram mask with the labels to be
+            exported. It must not be changed afterwards.
+        callback : function
+            Called in the GUI thread with the output file name when the
+            export is done (with None if it failed).
+
+        """
+        # get new flex file name and check for overwriting, including the
+        # exports that are still queued
+        ext = get_nifti_extension(cfg.gzip_level)
         self.nrExports = 0
-        self.flexfilename = '_labels_' + str(self.nrExports) + '.nii.gz'
-        while os.path.isfile(self.basename + self.flexfilename):
+        self.flexfilename = '_labels_' + str(self.nrExports) + ext
+        while (os.path.isfile(self.basename + self.flexfilename)
+               or self.basename + self.flexfilename in self.exportFiles):
             self.nrExports += 1
-            self.flexfilename = '_labels_' + str(self.nrExports) + '.nii.gz'
-        save(new_image, self.basename + self.flexfilename)
-        print("successfully exported image labels as: \n"
-              + self.basename + self.flexfilename)
+            self.flexfilename = '_labels_' + str(self.nrExports) + ext
+        filename = self.basename + self.flexfilename
+        self.exportFiles.append(filename)
+        self.exportMessages.put((filename, 'queued', None))
+        self.exportPool.apply_async(
+            self.writeLabels, (volHistMask, filename, callback))
+        self.exportTimer.start()
+
+    def writeLabels(self, volHistMask, filename, callback):
+        """Label the volume and save it as nifti (export thread)."""
+        try:
+            self.exportMessages.put((filename, 'labeling', None))
+            self.updateVolLabels(volHistMask)
+            self.exportMessages.put((filename, 'saving', None))
+            new_image = Nifti1Image(self.volLabels,
+                                    header=self.nii.header,
+                                    affine=self.nii.affine)
+            # store labels with their own (integer) type, not the input's
+            new_image.set_data_dtype(self.volLabels.dtype)
+            save_nifti(new_image, filename, gzip_level=cfg.gzip_level,
+                       nr_threads=cfg.nr_threads)
+            self.exportMessages.put((filename, 'done', callback))
+        except Exception as err:
+            print("exporting " + filename + " failed: " + str(err))
+            self.exportMessages.put((filename, 'failed', callback))
+
+    def pollExports(self):
+        """Show the export progress in the figure title (GUI thread)."""
+        while True:
+            try:
+                filename, status, callback = self.exportMessages.get_nowait()
+            except queue.Empty:
+                break
+            self.exportStatus = (os.path.basename(filename) + ': ' + status)
+            if status in ['done', 'failed']:
+                self.exportFiles.remove(filename)
+                if callback is not None:
+                    callback(filename if status == 'done' else None)
+        if self.exportFiles:
+            title = 'Exporting labels (' + self.exportStatus
+            if len(self.exportFiles) > 1:
+                title += ', ' + str(len(self.exportFiles) - 1) + ' queued'
+            title += ')'
+        else:
+            title = ''
+            self.exportTimer.stop()
+        self.figure.suptitle(title)
+        self.figure.canvas.draw_idle()
+
+    def exportDone(self, filename):
+        """Report a finished export."""
+        if filename is not None:
+            print("successfully exported image labels as: \n" + filename)
+
+    def updateVolLabels(self, volHistMask):
+        """Update full volume labels, only where histogram labels changed.
+
+        Parameters
+        ----------
+        volHistMask : 2D numpy array
+            Volume histogram mask with the (non-negative integer) labels to
+            be exported.
+
+        Notes
+        -----
+        Labels are stored with the smallest unsigned integer type that fits
+        the largest label.
+
+        """
+        dtype = np.min_scalar_type(int(np.max(volHistMask)))
+        if self.binPtr is None:  # out-of-core, label the volume in slabs
+            if (self.volLabels is None
+                    or not np.can_cast(dtype, self.volLabels.dtype)):
+                self.volLabels = create_scratch_array(
+                    self.scratchDir, 'labels_' + np.dtype(dtype).name,
+                    self.dims, dtype=dtype)
+            map_2D_hist_to_ima_chunked(self.invHistVolume, volHistMask,
+                                       self.volLabels, cfg.chunk_size,
+                                       discard_zeros=cfg.discard_zeros)
+            return
+        lut = create_2D_hist_lut(volHistMask, discard_zeros=cfg.discard_zeros)
+        if self.volLabels is None:
+            self.volLabels = np.zeros(self.dims, dtype=dtype)
+            self.volLabelsLut = np.zeros(lut.shape)
+        elif not np.can_cast(dtype, self.volLabels.dtype):
+            self.volLabels = self.volLabels.astype(dtype)
+        nr_vox = update_labels_from_bin_index(self.volLabels,
+                                              self.volLabelsLut, lut,
+                                              self.binPtr, self.voxIdx)
+        self.volLabelsLut = lut
+        print("  " + str(nr_vox) + " voxel labels are updated.")
 
     def clearOverlays(self):
         """Clear overlaid items such as circle highlights."""
@@ -429,6 +696,7 @@ class responsiveObj:
             {h.remove() for h in self.highlights[0]}
             {h.remove() for h in self.highlights[1]}
         self.highlights[0] = []
+        self.highlights[1] = []
 
     def resetGlobal(self, event):
         """Reset stuff."""
@@ -440,7 +708,7 @@ class responsiveObj:
         self.TranspVal = 0.5
         if self.segmType == 'main':
             if self.lassoSwitchCount == 1:  # reset only lasso drawing
-                self.idxLasso = np.zeros(self.nrBins*self.nrBins, dtype=bool)
+                self.lassoMask[:] = False
             else:
                 # reset theta sliders
                 self.sThetaMin.reset()
@@ -454,11 +722,8 @@ class responsiveObj:
 
         elif self.segmType == 'ncut':
             self.sLabelNr.reset()
-            # reset ncut labels
-            self.ima_ncut_labels = np.copy(self.orig_ncut_labels)
             # reset values for volHistMask
-            self.volHistMask = self.ima_ncut_labels[:, :, 0].reshape(
-                (self.nrBins, self.nrBins))
+            self.volHistMask = self.getNcutLevel(0)
             # reset counter field
             self.counterField = np.zeros((self.nrBins, self.nrBins))
             # reset political borders
@@ -466,17 +731,15 @@ class responsiveObj:
             self.pltMapH.set_data(self.pltMap)
         self.updateSliceNr()
         self.remapMsks()
-        self.updatePanels(update_slice=False, update_rotation=True,
-                          update_extent=False)
+        self.updatePanels(update_slice=False, update_extent=False)
 
     def updateThetaMin(self, val):
         """Update theta (min) in volume histogram mask."""
         if self.segmType == 'main':
             theta_val = self.sThetaMin.val  # get theta value from slider
             self.sectorObj.theta_min(theta_val)
-            self.remapMsks()
-            self.updatePanels(update_slice=False, update_rotation=True,
-                              update_extent=False)
+            self.scheduleUpdate(preview=True, update_slice=False,
+                                update_extent=False)
         else:
             return
 
@@ -485,9 +748,8 @@ class responsiveObj:
         if self.segmType == 'main':
             theta_val = self.sThetaMax.val  # get theta value from slider
             self.sectorObj.theta_max(theta_val)
-            self.remapMsks()
-            self.updatePanels(update_slice=False, update_rotation=True,
-                              update_extent=False)
+            self.scheduleUpdate(preview=True, update_slice=False,
+                                update_extent=False)
         else:
             return
 
@@ -524,7 +786,7 @@ class responsiveObj:
         if (self.TranspVal + incr >= 0) & (self.TranspVal + incr <= 1):
             self.TranspVal += incr
         self.imaSlcMskH.set_alpha(self.TranspVal)
-        self.figure.canvas.draw()
+        self.blitPanels()
 
     def imaSlcMskTransSwitch(self):
         """Update transparency of image mask to toggle transparency."""
@@ -533,7 +795,7 @@ class responsiveObj:
             self.imaSlcMskH.set_alpha(0)
         else:  # set imaSlcMsk opaque
             self.imaSlcMskH.set_alpha(self.TranspVal)
-        self.figure.canvas.draw()
+        self.blitPanels()
 
     def volHistHighlightTransSwitch(self):
         """Update transparency of highlights to toggle transparency."""
@@ -543,7 +805,7 @@ class responsiveObj:
                 {h.set_visible(False) for h in self.highlights[0]}
         elif self.volHistHighlightSwitch == 0 and self.highlights[0]:
                 {h.set_visible(True) for h in self.highlights[0]}
-        self.figure.canvas.draw()
+        self.blitPanels()
 
     def updateLabelsRadio(self, val):
         """Update labels with radio buttons."""
@@ -558,12 +820,9 @@ class responsiveObj:
         self.pltMapH.set_data(self.pltMap)
         self.pltMapH.set_extent((0, self.nrBins, self.nrBins, 0))
 
-    def lassoArr(self, array, indices):
-        """Lasso related."""
-        lin = np.arange(array.size)
-        newArray = array.flatten()
-        newArray[lin[indices]] = 1
-        return newArray.reshape(array.shape)
+    def lassoArr(self, array, mask):
+        """Add the lasso selection to a mask (in place)."""
+        return np.logical_or(array, mask, out=array)
 
     def calcImaMaskBrd(self):
         """Calculate borders of image mask slice."""
@@ -571,6 +830,51 @@ class responsiveObj:
         return np.greater(np.abs(grad[0], 2) + np.abs(grad[1], 2), 0)
 
 
+class sliceTransform:
+    """Rotation of a displayed slice in steps of 90 degrees.
+
+    The slice data are never rotated. Odd rotations display the transposed
+    slice (a view), all flips are done by the image extent. Display
+    coordinates are mapped back to slice indices arithmetically.
+
+    """
+
+    def __init__(self, shape, rotation=0):
+        self.shape = shape  # (rows, columns) of the slice
+        self.rotation = rotation % 4  # counterclockwise, like np.rot90
+
+    def displayShape(self):
+        """Return (rows, columns) of the displayed slice."""
+        if self.rotation % 2 == 1:
+            return self.shape[::-1]
+        return self.shape
+
+    def displayData(self, slc):
+        """Return the slice data to be displayed with extent()."""
+        if self.rotation % 2 == 1:
+            return slc.T
+        return slc
+
+    def extent(self):
+        """Return the imshow extent (left, right, bottom, top)."""
+        rows, cols = self.shape
+        return [(0, cols, rows, 0), (0, rows, 0, cols),
+                (cols, 0, 0, rows), (rows, 0, cols, 0)][self.rotation]
+
+    def toArray(self, x, y):
+        """Map display coordinates to (row, column) indices of the slice."""
+        rows, cols = self.shape
+        i, j = int(np.floor(y)), int(np.floor(x))  # displayed row, column
+        if self.rotation == 0:
+            return i, j
+        elif self.rotation == 1:
+            return j, cols - 1 - i
+        elif self.rotation == 2:
+            return rows - 1 - i, cols - 1 - j
+        else:
+            return rows - 1 - j, i
+
+
 class sector_mask:
     """A pacman-like shape with useful parameters.
 
@@ -584,36 +888,41 @@ class sector_mask:
     def __init__(self, shape, centre, radius, angle_range):
         self.radius = radius
         self.shape = shape
-        self.x, self.y = np.ogrid[:shape[0], :shape[1]]
         self.cx, self.cy = centre
         self.tmin, self.tmax = np.deg2rad(angle_range)
         # ensure stop angle > start angle
         if self.tmax < self.tmin:
             self.tmax += 2*np.pi
-        # convert cartesian --> polar coordinates
-        self.r2 = (self.x-self.cx)*(self.x-self.cx) + (
-            self.y-self.cy)*(self.y-self.cy)
-        self.theta = np.arctan2(self.x-self.cx, self.y-self.cy) - self.tmin
-        # wrap angles between 0 and 2*pi
-        self.theta %= (2*np.pi)
-
-    def set_polCrd(self):
-        """Convert cartesian to polar coordinates."""
-        self.r2 = (self.x-self.cx)*(self.x-self.cx) + (
-            self.y-self.cy)*(self.y-self.cy)
-        self.theta = np.arctan2(self.x-self.cx, self.y-self.cy) - self.tmin
-        # wrap angles between 0 and 2*pi
-        self.theta %= (2*np.pi)
+        # polar coordinates of all offsets between two bins, computed once.
+        # The mask of any centre is rasterized from a translated view.
+        ox, oy = np.ogrid[1-shape[0]:shape[0], 1-shape[1]:shape[1]]
+        self.grid_r2 = ox*ox + oy*oy
+        self.grid_theta = np.arctan2(ox, oy)
+
+    def centre_bin(self):
+        """Return the centre rounded to the nearest bin."""
+        return int(np.round(self.cx)), int(np.round(self.cy))
+
+    def polar_box(self, x0, x1, y0, y1):
+        """Polar coordinates of the bins in a box, relative to the centre."""
+        icx, icy = self.centre_bin()
+        gx0, gy0 = x0 - icx + self.shape[0] - 1, y0 - icy + self.shape[1] - 1
+        gx1, gy1 = gx0 + x1 - x0, gy0 + y1 - y0
+        if (gx0 >= 0 and gy0 >= 0 and gx1 <= self.grid_r2.shape[0]
+                and gy1 <= self.grid_r2.shape[1]):
+            return (self.grid_r2[gx0:gx1, gy0:gy1],
+                    self.grid_theta[gx0:gx1, gy0:gy1])
+        # centre is far outside of the histogram
+        ox, oy = np.ogrid[x0-icx:x1-icx, y0-icy:y1-icy]
+        return ox*ox + oy*oy, np.arctan2(ox, oy)
 
     def set_x(self, x):
         """Set x axis value."""
         self.cx = x
-        self.set_polCrd()  # update polar coordinates
 
     def set_y(self, y):
         """Set y axis value."""
         self.cy = y
-        self.set_polCrd()  # update polar coordinates
 
     def set_r(self, radius):
         """Set radius of the circle."""
@@ -628,7 +937,6 @@ class sector_mask:
         rad = np.deg2rad(degree)
         self.tmin += rad
         self.tmax += rad
-        self.set_polCrd()  # update polar coordinates
 
     def theta_min(self, degree):
         """Angle to determine one the cut out piece in circular mask."""
@@ -640,8 +948,6 @@ class sector_mask:
         # ensure stop angle- 2*np.pi NOT > start angle
         if self.tmax - 2*np.pi >= self.tmin:
             self.tmax -= 2*np.pi
-        # update polar coordinates
-        self.set_polCrd()
 
     def theta_max(self, degree):
         """Angle to determine one the cut out piece in circular mask."""
@@ -653,28 +959,37 @@ class sector_mask:
         # ensure stop angle- 2*np.pi NOT > start angle
         if self.tmax - 2*np.pi >= self.tmin:
             self.tmax -= 2*np.pi
-        # update polar coordinates
-        self.set_polCrd()
 
     def binaryMask(self):
         """Return a boolean mask for a circular sector."""
+        mask = np.zeros(self.shape, dtype=bool)
+        # only rasterize the bounding box of the circle
+        icx, icy = self.centre_bin()
+        x0 = max(icx - int(self.radius), 0)
+        x1 = min(icx + int(self.radius) + 1, self.shape[0])
+        y0 = max(icy - int(self.radius), 0)
+        y1 = min(icy + int(self.radius) + 1, self.shape[1])
+        if x0 >= x1 or y0 >= y1:
+            return mask
+        r2, theta = self.polar_box(x0, x1, y0, y1)
+        box = mask[x0:x1, y0:y1]
         # circular mask
-        self.circmask = self.r2 <= self.radius*self.radius
-        # angular mask
-        self.anglemask = self.theta <= (self.tmax-self.tmin)
-        # return binary mask
-        return self.circmask*self.anglemask
+        np.less_equal(r2, self.radius*self.radius, out=box)
+        # angular mask, rotation is an offset to the precomputed angles
+        if self.tmax - self.tmin < 2*np.pi:
+            box &= (theta - self.tmin) % (2*np.pi) <= (self.tmax-self.tmin)
+        return mask
 
     def contains(self, event):
         """Check if a cursor pointer is inside the sector mask."""
-        xbin = np.floor(event.xdata)
-        ybin = np.floor(event.ydata)
-        Mask = self.binaryMask()
-        # the next line doesn't follow pep 8 (otherwise it fails)
-        if Mask[ybin][xbin] is True:  # switch x and ybin, volHistMask not Cart
-            return True
-        else:
+        # switch x and y bins, volHistMask not Cartesian
+        xbin = int(np.floor(event.ydata))
+        ybin = int(np.floor(event.xdata))
+        if not (0 <= xbin < self.shape[0] and 0 <= ybin < self.shape[1]):
             return False
+        r2, theta = self.polar_box(xbin, xbin+1, ybin, ybin+1)
+        return bool(r2[0, 0] <= self.radius*self.radius and (
+            theta[0, 0] - self.tmin) % (2*np.pi) <= (self.tmax-self.tmin))
 
     def draw(self, ax, cmap='Reds', alpha=0.2, vmin=0.1,
              interpolation='nearest', origin='lower', extent=[0, 100, 0, 100]):
@@ -20,8 +20,12 @@
 import os
 import numpy as np
 import config as cfg
-from segmentator.utils import truncate_range, scale_range
+from segmentator.utils import load_float32_data, preprocess_ima
 from segmentator.utils import set_gradient_magnitude, prep_2D_hist
+from segmentator.chunk_utils import create_scratch_dir
+from segmentator.chunk_utils import preprocess_chunked, prep_2D_hist_chunked
+from segmentator.cache_utils import create_config_cache_key
+from segmentator.cache_utils import load_cache, save_cache
 from nibabel import load
 
 # load data
@@ -29,16 +33,38 @@ nii = load(cfg.filename)
 basename = nii.get_filename().split(os.extsep, 1)[0]
 
 # data processing
-orig = np.squeeze(nii.get_data())
-orig, _, _ = truncate_range(orig, percMin=cfg.perc_min, percMax=cfg.perc_max)
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
+cache_names = ['orig', 'gra', 'counts', 'invHistVolume', 'ranges']
+cache_key = create_config_cache_key() if cfg.use_cache else None
+cached = load_cache(cache_key, cache_names) if cfg.use_cache else None
+if cached is not None:
+    print('--Using cached preprocessing and histogram.')
+    counts = cached[cache_names.index('counts')]
+elif cfg.chunk_size > 0:  # out-of-core processing
+    scratch_dir = create_scratch_dir(cfg.scratch_dir)
+    orig, gra, pMin, pMax = preprocess_chunked(nii, scratch_dir,
+                                               cfg.chunk_size,
+                                               nr_threads=cfg.nr_threads)
+    counts, d_min, d_max, _, _, vox2pixMap = prep_2D_hist_chunked(
+        orig, gra, scratch_dir, cfg.chunk_size,
+        discard_zeros=cfg.discard_zeros, nr_threads=cfg.nr_threads)
+else:
+    orig = load_float32_data(nii)
+    orig, pMin, pMax, zeros = preprocess_ima(orig, percMin=cfg.perc_min,
+                                             percMax=cfg.perc_max,
+                                             scale_factor=cfg.scale,
+                                             delta=0.0001,
+                                             approx=cfg.perc_approx)
+    gra = set_gradient_magnitude(orig, cfg.gramag, nr_threads=cfg.nr_threads)
+    counts, d_min, d_max, _, _, vox2pixMap = prep_2D_hist(
+        np.ravel(orig), np.ravel(gra), discard_zeros=cfg.discard_zeros,
+        nr_threads=cfg.nr_threads, zeros=np.ravel(zeros))
+    vox2pixMap = np.reshape(vox2pixMap, orig.shape)
 
-# reshape ima (a bit more intuitive for voxel-wise operations)
-ima = np.ndarray.flatten(orig)
-gra = np.ndarray.flatten(gra)
+if cfg.use_cache and cached is None:
+    # also cache the products needed by the GUI for the next session
+    save_cache(cache_key, dict(zip(cache_names, [
+        orig, gra, counts, vox2pixMap, [pMin, pMax, d_min, d_max]])))
 
-counts, _, _, _, _, _ = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
 outName = (basename + '_volHist'
            + '_pMax' + str(cfg.perc_max) + '_pMin' + str(cfg.perc_min)
            + '_sc' + str(int(cfg.scale))
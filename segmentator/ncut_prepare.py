@@ -9,57 +9,12 @@ import os
 import numpy as np
 from matplotlib import animation
 from matplotlib import pyplot as plt
-from skimage.future import graph
-from skimage.segmentation import slic
+from segmentator.ncut_utils import norm_grap_cut, ncut_sweep
+from segmentator.ncut_utils import save_ncut_labels, save_ncut_sweep
+from segmentator.ncut_utils import describe_ncut_sweep
 import config as cfg
 
 
-def norm_grap_cut(image, max_edge=10000000, max_rec=4, compactness=2,
-                  nrSupPix=2000):
-    """Normalized graph cut wrapper for 2D numpy arrays.
-
-    Parameters
-    ----------
-        image: np.ndarray (2D)
-            Volume histogram.
-        max_edge: float
-            The maximum possible value of an edge in the RAG. This corresponds
-            to an edge between identical regions. This is used to put self
-            edges in the RAG.
-        compactness: float
-            From skimage slic_superpixels.py slic function:
-            Balances color proximity and space proximity. Higher values give
-            more weight to space proximity, making superpixel shapes more
-            square/cubic. This parameter depends strongly on image contrast and
-            on the shapes of objects in the image.
-        nrSupPix: int, positive
-            The (approximate) number of superpixels in the region adjacency
-            graph.
-
-    Returns
-    -------
-        labels2, labels1: np.ndarray (2D)
-            Segmented volume histogram mask image. Each label has a unique
-            identifier.
-
-    """
-    # scale for uint8 conversion
-    image = np.round(255 / image.max() * image)
-    image = image.astype('uint8')
-
-    # scikit implementation expects rgb format (shape: NxMx3)
-    image = np.tile(image, (3, 1, 1))
-    image = np.transpose(image, (1, 2, 0))
-
-    labels1 = slic(image, compactness=compactness, n_segments=nrSupPix,
-                   sigma=2)
-    # region adjacency graph (rag)
-    g = graph.rag_mean_color(img, labels1, mode='similarity_and_proximity')
-    labels2 = graph.cut_normalized(labels1, g, max_edge=max_edge,
-                                   num_cuts=1000, max_rec=max_rec)
-    return labels2, labels1
-
-
 path = cfg.filename
 basename = path.split(os.extsep, 1)[0]
 
@@ -72,16 +27,32 @@ img = np.log10(img+1.)
 img_max = cfg.cbar_init
 img[img > img_max] = img_max
 
-max_recursion = cfg.max_rec
-ncut = np.zeros((img.shape[0], img.shape[1], max_recursion + 1))
-for i in range(0, max_recursion + 1):
-    msk, regions = norm_grap_cut(img, max_rec=i,
-                                 nrSupPix=cfg.nr_sup_pix,
-                                 compactness=cfg.compactness)
-    ncut[:, :, i] = msk
+# parameters can be single values or grids
+max_rec = np.atleast_1d(cfg.max_rec).tolist()
+nr_sup_pix = np.atleast_1d(cfg.nr_sup_pix).tolist()
+compactness = np.atleast_1d(cfg.compactness).tolist()
+
+sweep = len(max_rec) * len(nr_sup_pix) * len(compactness) > 1
+if sweep:
+    print('  Sweeping ' + str(len(nr_sup_pix) * len(compactness))
+          + ' superpixel configurations with ' + str(cfg.nr_threads)
+          + ' processes...')
+    results = ncut_sweep(img, nr_sup_pix, compactness, max_rec,
+                         nr_processes=cfg.nr_threads,
+                         edge_sigma=cfg.edge_sigma)
+    if cfg.ncut_figs:
+        print('  Figures are not shown for parameter sweeps, open an entry '
+              'with --ncut and --ncut_entry instead.')
+else:
+    # all recursion levels are computed in a single pass
+    ncut, regions = norm_grap_cut(img, max_rec=max_rec[0],
+                                  nrSupPix=nr_sup_pix[0],
+                                  compactness=compactness[0],
+                                  edge_sigma=cfg.edge_sigma)
+    msk = ncut[:, :, -1]
 
 # plots
-if cfg.ncut_figs:
+if cfg.ncut_figs and not sweep:
     fig = plt.figure()
     ax1 = fig.add_subplot(121)
     ax2 = fig.add_subplot(122)
@@ -115,7 +86,17 @@ if cfg.ncut_figs:
     plt.show()
 
 # save output
-outName = basename + '_ncut' + '_sp' + str(cfg.nr_sup_pix) \
-          + '_c' + str(cfg.compactness)
-outName = outName.replace('.', 'pt')
-np.save(outName, ncut)
+if sweep:
+    # all label trees go into one indexed archive
+    outName = basename + '_ncut_sweep'
+    save_ncut_sweep(outName, results)
+    print('  Saved ' + str(len(results)) + ' entries as: ' + outName
+          + '.npz')
+    print(describe_ncut_sweep({'nr_sup_pix': [r[0] for r in results],
+                               'compactness': [r[1] for r in results],
+                               'max_rec': [r[2] for r in results]}))
+else:
+    outName = basename + '_ncut' + '_sp' + str(nr_sup_pix[0]) \
+              + '_c' + str(compactness[0])
+    outName = outName.replace('.', 'pt')
+    save_ncut_labels(outName, ncut, regions)
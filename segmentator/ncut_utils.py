@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+"""Normalized graph cut functions for segmentator (experimental)."""
+
+# Part of the Segmentator library
+# Copyright (C) 2016  Omer Faruk Gulban and Marian Schneider
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+import numpy as np
+from multiprocessing import Pool
+from scipy import sparse
+from scipy.sparse.linalg import eigsh
+
+
+def histogram_rag(image, labels, edge_sigma=255., max_edge=1.0):
+    """Region adjacency graph of superpixels in a single channel image.
+
+    Nodes are the superpixels, edges connect superpixels that touch
+    (8-connectivity). Edge weights are the similarity of the mean image
+    values, exp(-diff**2 / edge_sigma), computed for all edges at once.
+
+    Parameters
+    ----------
+    image : np.ndarray (2D)
+        Single channel image, e.g. the log counts of a volume histogram.
+    labels : np.ndarray (2D, int)
+        Superpixel labels.
+    edge_sigma : float
+        Scale of the squared differences of the mean image values. The
+        default is the sigma of skimage's rag_mean_color.
+    max_edge : float
+        Weight of the self edges (see skimage cut_normalized).
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        Symmetric weight matrix, rows and columns are ordered like nodes.
+    nodes : np.ndarray
+        Sorted node (superpixel) labels.
+
+    """
+    nodes, index = np.unique(labels, return_inverse=True)
+    index = index.reshape(labels.shape)
+    nr_nodes = len(nodes)
+    means = np.bincount(index.ravel(), weights=image.ravel(),
+                        minlength=nr_nodes)
+    means /= np.bincount(index.ravel(), minlength=nr_nodes)
+
+    # pairs of horizontal, vertical and diagonal neighbours
+    pairs = [(index[:, :-1], index[:, 1:]),
+             (index[:-1, :], index[1:, :]),
+             (index[:-1, :-1], index[1:, 1:]),
+             (index[:-1, 1:], index[1:, :-1])]
+    u = np.concatenate([a.ravel() for a, _ in pairs]).astype(np.int64)
+    v = np.concatenate([b.ravel() for _, b in pairs]).astype(np.int64)
+    border = u != v
+    edges = np.unique(np.minimum(u[border], v[border]) * nr_nodes
+                      + np.maximum(u[border], v[border]))
+    u, v = np.divmod(edges, nr_nodes)
+
+    vals = np.exp(-np.power(means[u] - means[v], 2) / edge_sigma)
+    weights = sparse.coo_matrix(
+        (np.concatenate([vals, vals]),
+         (np.concatenate([u, v]), np.concatenate([v, u]))),
+        shape=(nr_nodes, nr_nodes))
+    weights = weights + max_edge * sparse.identity(nr_nodes)
+    return weights.tocsr(), nodes
+
+
+def ncut_bipartition(weights, thresh=0.001, num_cuts=10, rand=np.random):
+    """Find the minimum 2-way normalized cut of a graph.
+
+    Follows skimage's `_ncut_relabel` (Shi & Malik 2001): the second
+    smallest eigenvector of the normalized Laplacian is thresholded at
+    `num_cuts` evenly spaced values and the cheapest cut is kept.
+
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix
+        Symmetric weight matrix of the graph, including self edges.
+    thresh : float
+        The graph is not cut if the value of the best N-cut exceeds thresh.
+    num_cuts : int
+        Number of N-cuts to evaluate before determining the optimal one.
+    rand : np.random.RandomState
+        Provides the initial vector of the eigenvalue solver.
+
+    Returns
+    -------
+    cut : np.ndarray (1D, bool) or None
+        Nodes on one side of the cut. None if the graph cannot be cut.
+
+    """
+    nr_nodes = weights.shape[0]
+    off_diag = weights - sparse.diags(weights.diagonal())
+    if nr_nodes <= 2 or not np.any(off_diag.data):
+        return None
+    degree = np.asarray(weights.sum(axis=1)).ravel()
+    d_inv_sqrt = sparse.diags(1. / np.sqrt(degree))
+    lap = d_inv_sqrt.dot(sparse.diags(degree) - weights).dot(d_inv_sqrt)
+    vals, vectors = eigsh(lap, which='SM', v0=rand.rand(nr_nodes),
+                          k=min(100, nr_nodes - 2))
+    # second smallest eigenvector, like skimage's argmin2 the only one for
+    # three nodes (k=1)
+    ev = vectors[:, np.argsort(vals)[min(1, len(vals) - 1)]]
+    ev_min, ev_max = np.min(ev), np.max(ev)
+    if np.allclose(ev_min, ev_max):
+        return None
+
+    # evaluate evenly spaced cuts, refer Shi & Malik 2001, Section 3.1.3
+    total = np.sum(degree)
+    min_cut, min_cost = None, np.inf
+    for t in np.linspace(ev_min, ev_max, num_cuts, endpoint=False):
+        cut = ev > t
+        cut_weight = np.dot(~cut, weights.dot(cut.astype(np.float64)))
+        assoc = np.sum(degree[cut])
+        cost = cut_weight / assoc + cut_weight / (total - assoc)
+        if cost < min_cost:
+            min_cut, min_cost = cut, cost
+    return min_cut if min_cost < thresh else None
+
+
+def ncut_hierarchy(weights, max_rec, thresh=0.001, num_cuts=10, seed=0):
+    """Recursive normalized cut that records every recursion level.
+
+    Level i of the output is the partition that a normalized cut limited to
+    i recursions produces, so a single pass replaces max_rec+1 cuts.
+
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix
+        Symmetric weight matrix of the graph, including self edges.
+    max_rec : int
+        Maximum recursion depth.
+    thresh : float
+        A subgraph is not cut further if the value of its N-cut exceeds
+        thresh.
+    num_cuts : int
+        Number of N-cuts to evaluate before determining the optimal one.
+    seed : int
+        Seed for the initial vectors of the eigenvalue solver.
+
+    Returns
+    -------
+    labels : np.ndarray, shape (nr_nodes, max_rec+1)
+        Node labels for every recursion level. Labels are unique across
+        all levels.
+
+    """
+    weights = sparse.csr_matrix(weights)
+    rand = np.random.RandomState(seed)
+    labels = np.zeros((weights.shape[0], max_rec + 1), dtype=np.int64)
+    stack = [(np.arange(weights.shape[0]), 0)]
+    new_label = 0
+    while stack:
+        nodes, depth = stack.pop()
+        # deeper levels are overwritten if this subgraph is cut further
+        labels[nodes, depth:] = new_label
+        new_label += 1
+        if depth == max_rec:
+            continue
+        cut = ncut_bipartition(weights[nodes][:, nodes], thresh=thresh,
+                               num_cuts=num_cuts, rand=rand)
+        if cut is not None:
+            stack.append((nodes[~cut], depth + 1))
+            stack.append((nodes[cut], depth + 1))
+    return labels
+
+
+def ncut_superpixels(image, max_edge=10000000, compactness=2,
+                     nrSupPix=2000, edge_sigma=255.):
+    """Compute superpixels and the RAG weights of a volume histogram.
+
+    Parameters
+    ----------
+        image: np.ndarray (2D)
+            Log counts of the volume histogram.
+        max_edge: float
+            The maximum possible value of an edge in the RAG. This corresponds
+            to an edge between identical regions. This is used to put self
+            edges in the RAG.
+        compactness: float
+            From skimage slic_superpixels.py slic function:
+            Balances color proximity and space proximity. Higher values give
+            more weight to space proximity, making superpixel shapes more
+            square/cubic. This parameter depends strongly on image contrast and
+            on the shapes of objects in the image.
+        nrSupPix: int, positive
+            The (approximate) number of superpixels in the region adjacency
+            graph.
+        edge_sigma: float
+            Scale of the squared log count differences in the edge weights,
+            see `histogram_rag`. Log counts differ by at most cbar_init, so
+            the default 255 weights all edges almost equally (like the
+            earlier rag_mean_color graph) and the cut is mostly spatial.
+            Values around 1 make the cut follow the log counts.
+
+    Returns
+    -------
+        labels1: np.ndarray (2D)
+            Superpixel labels.
+        weights: scipy.sparse.csr_matrix
+            RAG weight matrix, see `histogram_rag`.
+        nodes: np.ndarray (1D)
+            Superpixel labels of the rows and columns of weights.
+
+    """
+    # slic used to convert the gray histogram to CIELAB, so compactness is
+    # relative to the lightness range. skimage rescales inputs to [0, 1]
+    # itself in newer versions, so rescale both here to keep its meaning.
+    lightness = gray_lab_lightness(image / np.max(image))
+    light_min, light_range = np.min(lightness), np.ptp(lightness)
+    labels1 = slic_gray((lightness - light_min) / light_range,
+                        compactness=compactness / light_range,
+                        n_segments=nrSupPix, sigma=2)
+    # region adjacency graph (rag)
+    weights, nodes = histogram_rag(image, labels1, edge_sigma=edge_sigma,
+                                   max_edge=max_edge)
+    return labels1, weights, nodes
+
+
+def gray_lab_lightness(image):
+    """CIELAB lightness of a gray sRGB image.
+
+    Equals the L channel of skimage's rgb2lab for an image with three
+    identical channels, without creating the channels.
+
+    Parameters
+    ----------
+        image: np.ndarray
+            Gray values in [0, 1].
+
+    Returns
+    -------
+        lightness: np.ndarray
+            Lightness in [0, 100].
+
+    """
+    linear = np.where(image > 0.04045,
+                      np.power((image + 0.055) / 1.055, 2.4), image / 12.92)
+    linear = np.where(linear > 0.008856, np.cbrt(linear),
+                      7.787 * linear + 16. / 116.)
+    return 116. * linear - 16.
+
+
+def slic_gray(image, **kwargs):
+    """Run skimage slic on a single channel image.
+
+    Newer skimage versions replaced the multichannel keyword with
+    channel_axis. skimage is imported here because it is only needed to
+    prepare ncut labels, not to load them.
+    """
+    from skimage.segmentation import slic
+    try:
+        return slic(image, channel_axis=None, **kwargs)
+    except TypeError:
+        return slic(image, multichannel=False, **kwargs)
+
+
+def ncut_superpixel_labels(labels1, weights, nodes, max_rec):
+    """Run the hierarchical cut and map it back to the superpixels.
+
+    Parameters
+    ----------
+        labels1: np.ndarray (2D)
+            Superpixel labels.
+        weights: scipy.sparse.csr_matrix
+            RAG weight matrix, see `histogram_rag`.
+        nodes: np.ndarray (1D)
+            Superpixel labels of the rows and columns of weights.
+        max_rec: int
+            Maximum recursion depth of the normalized cut.
+
+    Returns
+    -------
+        labels2: np.ndarray (3D)
+            Segmented volume histogram mask images, one for every recursion
+            level from 0 to max_rec along the last axis.
+
+    """
+    node_labels = ncut_hierarchy(weights, max_rec, num_cuts=1000)
+    lut = np.zeros((np.max(labels1) + 1, max_rec + 1), dtype=np.int64)
+    lut[nodes] = node_labels
+    return lut[labels1]
+
+
+def norm_grap_cut(image, max_edge=10000000, max_rec=4, compactness=2,
+                  nrSupPix=2000, edge_sigma=255.):
+    """Hierarchical normalized graph cut wrapper for 2D numpy arrays.
+
+    Superpixels and the region adjacency graph are computed once, then a
+    single recursive cut records the labels of every recursion level.
+
+    Parameters
+    ----------
+        image: np.ndarray (2D)
+            Volume histogram.
+        max_edge: float
+            See `ncut_superpixels`.
+        max_rec: int
+            Maximum recursion depth of the normalized cut.
+        compactness: float
+            See `ncut_superpixels`.
+        nrSupPix: int, positive
+            See `ncut_superpixels`.
+        edge_sigma: float
+            See `ncut_superpixels`.
+
+    Returns
+    -------
+        labels2: np.ndarray (3D)
+            Segmented volume histogram mask images, one for every recursion
+            level from 0 to max_rec along the last axis.
+        labels1: np.ndarray (2D)
+            Superpixel labels.
+
+    """
+    labels1, weights, nodes = ncut_superpixels(
+        image, max_edge=max_edge, compactness=compactness, nrSupPix=nrSupPix,
+        edge_sigma=edge_sigma)
+    labels2 = ncut_superpixel_labels(labels1, weights, nodes, max_rec)
+    return labels2, labels1
+
+
+def compress_ncut_labels(labels2, labels1):
+    """Store hierarchical ncut labels as a label tree.
+
+    The tree consists of the superpixel map and, for every level, an array
+    of parent pointers that maps the segments of the next deeper level (the
+    superpixels for the deepest level) to the segments of this level.
+
+    Parameters
+    ----------
+        labels2: np.ndarray (3D)
+            Nested ncut labels of every recursion level, see `norm_grap_cut`.
+        labels1: np.ndarray (2D)
+            Superpixel labels.
+
+    Returns
+    -------
+        tree: dict
+            'superpixels' holds the superpixel map and 'parents_i' the parent
+            pointers of level i, all stored as uint16 if possible.
+
+    """
+    _, index = np.unique(labels1, return_inverse=True)
+    index = index.reshape(labels1.shape)
+    _, first = np.unique(index, return_index=True)
+    node_labels = labels2.reshape(-1, labels2.shape[-1])[first]
+    dtype = np.uint16 if len(first) <= 2**16 else np.uint32
+    tree = {'superpixels': index.astype(dtype)}
+    children = np.arange(len(first))
+    for level in range(labels2.shape[-1] - 1, -1, -1):
+        _, segments = np.unique(node_labels[:, level], return_inverse=True)
+        parents = np.zeros(np.max(children) + 1, dtype=dtype)
+        parents[children] = segments.ravel()
+        tree['parents_' + str(level)] = parents
+        children = segments.ravel()
+    return tree
+
+
+def save_ncut_labels(filename, labels2, labels1):
+    """Save hierarchical ncut labels as a compressed label tree.
+
+    Parameters
+    ----------
+        filename: string
+            Output .npz file.
+        labels2: np.ndarray (3D)
+            Nested ncut labels of every recursion level.
+        labels1: np.ndarray (2D)
+            Superpixel labels.
+
+    """
+    np.savez_compressed(filename, **compress_ncut_labels(labels2, labels1))
+
+
+def load_ncut_labels(filename, prefix=''):
+    """Load ncut labels as a tree that expands one level at a time.
+
+    Parameters
+    ----------
+        filename: string
+            An .npz label tree (see `compress_ncut_labels`) or a dense .npy
+            label stack written by older versions.
+        prefix: string
+            Prefix of the tree arrays, used to pick an entry of a sweep
+            archive (e.g. 'ncut_0_').
+
+    Returns
+    -------
+        labels: ncutLabelTree
+            Labels of every recursion level, see `ncutLabelTree.level`.
+
+    """
+    if filename.endswith('.npy'):
+        # older dense stacks, levels are not necessarily nested
+        labels2 = np.load(filename)
+        node_labels, superpixels = np.unique(
+            labels2.reshape(-1, labels2.shape[-1]), axis=0,
+            return_inverse=True)
+        return ncutLabelTree(superpixels.reshape(labels2.shape[:-1]),
+                             node_labels)
+    with np.load(filename) as tree:
+        if prefix + 'superpixels' not in tree.files:
+            if 'nr_sup_pix' in tree.files:
+                raise ValueError(describe_ncut_sweep(tree))
+            raise ValueError(filename + ' holds no ncut labels with prefix '
+                             + repr(prefix) + '.')
+        nr_levels = len([k for k in tree.files
+                         if k.startswith(prefix + 'parents_')])
+        superpixels = tree[prefix + 'superpixels']
+        # walk up the tree to find the segment of every superpixel per level
+        node_labels = np.zeros((np.max(superpixels) + 1, nr_levels),
+                               dtype=np.int64)
+        segments = np.arange(node_labels.shape[0])
+        for level in range(nr_levels - 1, -1, -1):
+            segments = tree[prefix + 'parents_' + str(level)][segments]
+            node_labels[:, level] = segments
+    return ncutLabelTree(superpixels, node_labels)
+
+
+class ncutLabelTree:
+    """Hierarchical ncut labels that are expanded one level at a time.
+
+    Only the superpixel map and a small table with the label of every
+    superpixel on every level are kept in memory. Labels are relabeled like
+    `relabel_ncut_levels`, so they are unique across levels.
+    """
+
+    def __init__(self, superpixels, node_labels):
+        """Relabel the superpixel labels of every level.
+
+        Parameters
+        ----------
+            superpixels: np.ndarray (2D, int)
+                Superpixel index of every histogram bin.
+            node_labels: np.ndarray (2D), shape (nr_superpixels, nr_levels)
+                Label of every superpixel on every level.
+
+        """
+        self.superpixels = superpixels
+        self.nodeLabels = relabel_ncut_levels(node_labels)
+        self.nrLevels = node_labels.shape[1]
+        self.lMin = np.min(self.nodeLabels)
+        self.lMax = np.max(self.nodeLabels)
+
+    def level(self, level):
+        """Expand the labels of one recursion level into a 2D image."""
+        return self.nodeLabels[:, level][self.superpixels]
+
+
+def relabel_ncut_levels(labels2):
+    """Assign ascending, level-wise unique integers to ncut labels.
+
+    Labels of level i are replaced by consecutive entries of an ordering
+    that interleaves ascending and descending integers, starting after the
+    labels of level i-1. Every level is relabeled in one vectorized pass.
+
+    Parameters
+    ----------
+        labels2: np.ndarray (3D)
+            Labels of every recursion level along the last axis.
+
+    Returns
+    -------
+        labels: np.ndarray (3D, int)
+            Relabeled labels, unique across all levels.
+
+    """
+    nr_levels = labels2.shape[-1]
+    total_labels = np.arange(sum([2**x for x in range(nr_levels)]))
+    total_labels[1::2] = total_labels[-2:0:-2]
+    labels = np.zeros(labels2.shape, dtype=np.int64)
+    counter = 0
+    for level in range(nr_levels):
+        unique, inverse = np.unique(labels2[..., level], return_inverse=True)
+        labels[..., level] = total_labels[counter + inverse].reshape(
+            labels2.shape[:-1])
+        counter += len(unique)
+    return labels
+
+
+def describe_ncut_sweep(archive):
+    """List the entries of an ncut sweep archive.
+
+    Parameters
+    ----------
+        archive: dict-like
+            Opened sweep archive, see `save_ncut_sweep`.
+
+    Returns
+    -------
+        description: string
+            Hint to select an entry with its parameters, one per line.
+
+    """
+    lines = ['This is an ncut sweep archive, select an entry with '
+             '--ncut_entry:',
+             '  entry  nr_sup_pix  compactness  max_rec']
+    for i, params in enumerate(zip(archive['nr_sup_pix'],
+                                   archive['compactness'],
+                                   archive['max_rec'])):
+        lines.append('  %5i  %10i  %11g  %7i' % ((i,) + params))
+    return '\n'.join(lines)
+
+
+def ncut_sweep_job(job):
+    """Run the normalized cuts of one superpixel configuration.
+
+    Parameters
+    ----------
+        job: tuple
+            (image, nrSupPix, compactness, max_recs, edge_sigma), see
+            `ncut_sweep`.
+
+    Returns
+    -------
+        results: list of tuples
+            (nrSupPix, compactness, max_rec, tree) for every max_rec, see
+            `compress_ncut_labels`.
+
+    """
+    image, nrSupPix, compactness, max_recs, edge_sigma = job
+    labels1, weights, nodes = ncut_superpixels(
+        image, compactness=compactness, nrSupPix=nrSupPix,
+        edge_sigma=edge_sigma)
+    # every recursion limit is a prefix of the deepest hierarchy
+    labels2 = ncut_superpixel_labels(labels1, weights, nodes, max(max_recs))
+    return [(nrSupPix, compactness, max_rec,
+             compress_ncut_labels(labels2[..., :max_rec + 1], labels1))
+            for max_rec in max_recs]
+
+
+def ncut_sweep(image, nr_sup_pix, compactness, max_rec, nr_processes=1,
+               edge_sigma=255.):
+    """Run normalized cuts for a grid of parameters in a process pool.
+
+    Superpixels and RAG are computed once per combination of nr_sup_pix and
+    compactness and shared by all values of max_rec.
+
+    Parameters
+    ----------
+        image: np.ndarray (2D)
+            Volume histogram.
+        nr_sup_pix: list of ints
+            Numbers of superpixels.
+        compactness: list of floats
+            Superpixel compactness values.
+        max_rec: list of ints
+            Maximum recursion depths.
+        nr_processes: int
+            Number of worker processes.
+        edge_sigma: float
+            Scale of the RAG edge weights, see `ncut_superpixels`.
+
+    Returns
+    -------
+        results: list of tuples
+            (nrSupPix, compactness, max_rec, tree) for every combination,
+            ordered like the parameter grid. tree is a label tree, see
+            `compress_ncut_labels`.
+
+    """
+    jobs = [(image, sp, c, sorted(set(max_rec)), edge_sigma)
+            for sp in nr_sup_pix for c in compactness]
+    if nr_processes > 1 and len(jobs) > 1:
+        pool = Pool(min(nr_processes, len(jobs)))
+        try:
+            job_results = pool.map(ncut_sweep_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        job_results = [ncut_sweep_job(j) for j in jobs]
+    results = dict(((r[0], r[1], r[2]), r) for res in job_results
+                   for r in res)
+    return [results[(sp, c, rec)] for sp in nr_sup_pix for c in compactness
+            for rec in max_rec]
+
+
+def save_ncut_sweep(filename, results):
+    """Save the label trees of a parameter sweep into one archive.
+
+    The archive holds the index arrays 'nr_sup_pix', 'compactness' and
+    'max_rec', and the label tree of the i-th configuration with the array
+    names prefixed by 'ncut_i_' (see `load_ncut_labels`).
+
+    Parameters
+    ----------
+        filename: string
+            Output .npz file.
+        results: list of tuples
+            (nrSupPix, compactness, max_rec, tree), see `ncut_sweep`.
+
+    """
+    arrays = dict(('ncut_' + str(i) + '_' + name, arr)
+                  for i, r in enumerate(results)
+                  for name, arr in r[3].items())
+    np.savez_compressed(filename,
+                        nr_sup_pix=np.array([r[0] for r in results]),
+                        compactness=np.array([r[1] for r in results]),
+                        max_rec=np.array([r[2] for r in results]),
+                        **arrays)
@@ -28,31 +28,69 @@ from matplotlib.colors import LogNorm
 from matplotlib.widgets import Slider, Button, LassoSelector
 from matplotlib import path
 from nibabel import load
-from segmentator.utils import map_ima_to_2D_hist, prep_2D_hist
-from segmentator.utils import truncate_range, scale_range
+from segmentator.utils import prep_2D_hist
+from segmentator.utils import create_bin_to_vox_index
+from segmentator.utils import load_float32_data, preprocess_ima
 from segmentator.utils import set_gradient_magnitude
 from segmentator.utils import export_gradient_magnitude_image
+from segmentator.chunk_utils import create_scratch_dir
+from segmentator.chunk_utils import preprocess_chunked, prep_2D_hist_chunked
+from segmentator.cache_utils import create_config_cache_key
+from segmentator.cache_utils import load_cache, save_cache
 from gui_utils import sector_mask, responsiveObj
 
 #
 """Data Processing"""
 nii = load(cfg.filename)
-orig = np.squeeze(nii.get_data())
-dims = orig.shape
-orig, pMin, pMax = truncate_range(orig, percMin=cfg.perc_min,
-                                  percMax=cfg.perc_max)
+cache_names = ['orig', 'gra', 'counts', 'invHistVolume', 'ranges']
+cache_key = create_config_cache_key() if cfg.use_cache else None
+cached = load_cache(cache_key, cache_names) if cfg.use_cache else None
+if cfg.chunk_size > 0:  # out-of-core processing
+    scratch_dir = create_scratch_dir(cfg.scratch_dir)
+
+if cached is not None:
+    print('--Using cached preprocessing and histogram.')
+    orig, gra, counts, ima2volHistMap, ranges = cached
+    pMin, pMax, d_min, d_max = ranges
+    dims = orig.shape
+    nr_bins = int(d_max - d_min)
+    bin_edges = np.arange(d_min, d_max+1)
+elif cfg.chunk_size > 0:
+    orig, gra, pMin, pMax = preprocess_chunked(nii, scratch_dir,
+                                               cfg.chunk_size,
+                                               nr_threads=cfg.nr_threads)
+    dims = orig.shape
+    # Compute 2D histogram and image to histogram mapping
+    counts, d_min, d_max, nr_bins, bin_edges, ima2volHistMap \
+        = prep_2D_hist_chunked(orig, gra, scratch_dir, cfg.chunk_size,
+                               discard_zeros=cfg.discard_zeros,
+                               nr_threads=cfg.nr_threads)
+else:
+    orig = load_float32_data(nii)
+    dims = orig.shape
+    # Truncate and scale the original image in place, then compute gradient
+    orig, pMin, pMax, zeros = preprocess_ima(orig, percMin=cfg.perc_min,
+                                             percMax=cfg.perc_max,
+                                             scale_factor=cfg.scale,
+                                             delta=0.0001,
+                                             approx=cfg.perc_approx)
+    gra = set_gradient_magnitude(orig, cfg.gramag, nr_threads=cfg.nr_threads)
+    # Compute 2D histogram and image to histogram mapping
+    counts, d_min, d_max, nr_bins, bin_edges, ima2volHistMap \
+        = prep_2D_hist(np.ravel(orig), np.ravel(gra),
+                       discard_zeros=cfg.discard_zeros,
+                       nr_threads=cfg.nr_threads, zeros=np.ravel(zeros))
+    ima2volHistMap = np.reshape(ima2volHistMap, dims)
+
+if cfg.use_cache and cached is None:
+    save_cache(cache_key, dict(zip(cache_names, [
+        orig, gra, counts, ima2volHistMap, [pMin, pMax, d_min, d_max]])))
+
 # Save min and max truncation thresholds to be used in axis labels
 orig_range = [pMin, pMax]
-# Continue with scaling the original truncated image and recomputing gradient
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
 if cfg.export_gramag:
     export_gradient_magnitude_image(gra, nii.get_filename(), nii.affine)
 
-# Reshape for voxel-wise operations
-ima = np.copy(orig.flatten())
-gra = gra.flatten()
-
 #
 """Plots"""
 # Set up a colormap:
@@ -65,8 +103,9 @@ palette.set_bad('m', 1.0)
 fig = plt.figure(facecolor='0.775')
 ax = fig.add_subplot(121)
 
-counts, volHistH, d_min, d_max, nr_bins, bin_edges \
-    = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
+volHistH = ax.imshow(counts.T, cmap='Greys', origin='lower',
+                     interpolation='nearest', aspect='auto',
+                     extent=[d_min, d_max, d_min, d_max])
 
 # Set x-y axis range to the same (x-axis range)
 ax.set_xlim(d_min, d_max)
@@ -82,8 +121,8 @@ fig.colorbar(volHistH, fraction=0.046, pad=0.04)  # magical scaling
 # Plot 3D ima by default
 ax2 = fig.add_subplot(122)
 sliceNr = int(0.5*dims[2])
-imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray, vmin=ima.min(),
-                     vmax=ima.max(), interpolation='none',
+imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray, vmin=orig.min(),
+                     vmax=orig.max(), interpolation='none',
                      extent=[0, dims[1], dims[0], 0])
 
 imaSlcMsk = np.ones(dims[0:2])
@@ -110,7 +149,7 @@ volHistMaskH, volHistMask = sectorObj.draw(ax, cmap='Reds', alpha=0.2,
                                            extent=[0, nr_bins, 0, nr_bins])
 
 # Initiate a flexible figure object, pass to it useful properties
-idxLasso = np.zeros(nr_bins*nr_bins, dtype=bool)
+lassoMask = np.zeros((nr_bins, nr_bins), dtype=bool)
 lassoSwitchCount = 0
 flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
                         segmType='main', orig=orig, nii=nii,
@@ -119,17 +158,23 @@ flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
                         sliceNr=sliceNr,
                         imaSlcH=imaSlcH,
                         imaSlcMsk=imaSlcMsk, imaSlcMskH=imaSlcMskH,
+                        volHistH=volHistH,
                         volHistMask=volHistMask, volHistMaskH=volHistMaskH,
                         contains=volHistMaskH.contains,
                         counts=counts,
-                        idxLasso=idxLasso,
+                        lassoMask=lassoMask,
                         initTpl=(cfg.perc_min, cfg.perc_max, cfg.scale),
                         lassoSwitchCount=lassoSwitchCount)
 
 # Make the figure responsive to clicks
 flexFig.connect()
-ima2volHistMap = map_ima_to_2D_hist(xinput=ima, yinput=gra, bins_arr=bin_edges)
 flexFig.invHistVolume = np.reshape(ima2volHistMap, dims)
+if cfg.chunk_size > 0:  # inverted index does not fit into memory
+    flexFig.binPtr, flexFig.voxIdx = None, None
+    flexFig.scratchDir = scratch_dir
+else:
+    flexFig.binPtr, flexFig.voxIdx = create_bin_to_vox_index(ima2volHistMap,
+                                                             nr_bins)
 
 #
 """Sliders and Buttons"""
@@ -235,27 +280,27 @@ def lassoSwitch(event):
         bLasso.label.set_text("Lasso\nOff")
 
 
-# Pixel coordinates
-pix = np.arange(nr_bins)
-xv, yv = np.meshgrid(pix, pix)
-pix = np.vstack((xv.flatten(), yv.flatten())).T
-
-
 def onselect(verts):
     """Lasso related."""
-    global pix
     p = path.Path(verts)
-    newLasIdx = p.contains_points(pix, radius=1.5)  # new lasso indices
-    flexFig.idxLasso[newLasIdx] = True  # updated old lasso indices
+    # only test the bins around the bounding box of the lasso
+    x0, y0 = np.maximum(np.floor(np.min(verts, axis=0)).astype(int) - 2, 0)
+    x1, y1 = np.minimum(np.ceil(np.max(verts, axis=0)).astype(int) + 3,
+                        nr_bins)
+    if x0 >= x1 or y0 >= y1:
+        return
+    xv, yv = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+    newLasIdx = p.contains_points(np.column_stack((xv.ravel(), yv.ravel())),
+                                  radius=1.5)  # new lasso indices
+    # update the lasso layer (rows are y, columns are x)
+    flexFig.lassoMask[y0:y1, x0:x1] |= newLasIdx.reshape(xv.shape)
     # Update volume histogram mask
     flexFig.remapMsks()
-    flexFig.updatePanels(update_slice=False, update_rotation=True,
-                         update_extent=True)
+    flexFig.updatePanels(update_slice=False, update_extent=True)
 
 
 bLasso.on_clicked(lassoSwitch)
 flexFig.remapMsks()
-flexFig.updatePanels(update_slice=True, update_rotation=False,
-                     update_extent=False)
+flexFig.updatePanels(update_slice=True, update_extent=False)
 
 plt.show()
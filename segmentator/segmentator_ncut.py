@@ -30,68 +30,90 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm, ListedColormap, BoundaryNorm
 from matplotlib.widgets import Slider, Button, RadioButtons
 from nibabel import load
-from segmentator.utils import map_ima_to_2D_hist, prep_2D_hist
-from segmentator.utils import truncate_range, scale_range
+from segmentator.utils import prep_2D_hist
+from segmentator.utils import create_bin_to_vox_index
+from segmentator.utils import load_float32_data, preprocess_ima
 from segmentator.utils import set_gradient_magnitude
 from segmentator.utils import export_gradient_magnitude_image
+from segmentator.chunk_utils import create_scratch_dir
+from segmentator.chunk_utils import preprocess_chunked, prep_2D_hist_chunked
+from segmentator.cache_utils import create_config_cache_key
+from segmentator.cache_utils import load_cache, save_cache
+from segmentator.ncut_utils import load_ncut_labels
 from gui_utils import responsiveObj
 
 #
 """Load Data"""
 nii = load(cfg.filename)
-ncut_labels = np.load(cfg.ncut)
-
-# transpose the labels
-ncut_labels = np.transpose(ncut_labels, (1, 0, 2))
-nrTotal_labels = sum([2**x for x in range(ncut_labels.shape[2])])
-total_labels = np.arange(nrTotal_labels)
-total_labels[1::2] = total_labels[-2:0:-2]
-
-# relabel the labels from ncut, assign ascending integers starting with counter
-counter = 0
-for ind in np.arange(ncut_labels.shape[2]):
-    tmp = ncut_labels[:, :, ind]
-    uniqueVals = np.unique(tmp)
-    nrUniqueVals = len(uniqueVals)
-    newInd = np.arange(nrUniqueVals) + counter
-    newVals = total_labels[newInd]
-    tmp2 = np.zeros((tmp.shape))
-    for ind2, val in enumerate(uniqueVals):
-        tmp2[tmp == val] = newVals[ind2]
-    counter = counter + nrUniqueVals
-    ncut_labels[:, :, ind] = tmp2
-lMax = np.max(ncut_labels)
-
-orig_ncut_labels = ncut_labels.copy()
-ima_ncut_labels = ncut_labels.copy()
+if cfg.ncut_entry is None:
+    ncut_labels = load_ncut_labels(cfg.ncut)
+else:  # entry of a parameter sweep archive
+    ncut_labels = load_ncut_labels(cfg.ncut,
+                                   prefix='ncut_' + str(cfg.ncut_entry) + '_')
+# levels are expanded on demand, labels are unique across levels
+lMax = ncut_labels.lMax
 
 
 #
 """Data Processing"""
-orig = np.squeeze(nii.get_data())
-dims = orig.shape
-orig, pMin, pMax = truncate_range(orig, percMin=cfg.perc_min,
-                                  percMax=cfg.perc_max)
+cache_names = ['orig', 'gra', 'counts', 'invHistVolume', 'ranges']
+cache_key = create_config_cache_key() if cfg.use_cache else None
+cached = load_cache(cache_key, cache_names) if cfg.use_cache else None
+if cfg.chunk_size > 0:  # out-of-core processing
+    scratch_dir = create_scratch_dir(cfg.scratch_dir)
+
+if cached is not None:
+    print('--Using cached preprocessing and histogram.')
+    orig, gra, counts, ima2volHistMap, ranges = cached
+    pMin, pMax, d_min, d_max = ranges
+    dims = orig.shape
+    nr_bins = int(d_max - d_min)
+    bin_edges = np.arange(d_min, d_max+1)
+elif cfg.chunk_size > 0:
+    orig, gra, pMin, pMax = preprocess_chunked(nii, scratch_dir,
+                                               cfg.chunk_size,
+                                               nr_threads=cfg.nr_threads)
+    dims = orig.shape
+    # Compute 2D histogram and image to histogram mapping
+    counts, d_min, d_max, nr_bins, bin_edges, ima2volHistMap \
+        = prep_2D_hist_chunked(orig, gra, scratch_dir, cfg.chunk_size,
+                               discard_zeros=cfg.discard_zeros,
+                               nr_threads=cfg.nr_threads)
+else:
+    orig = load_float32_data(nii)
+    dims = orig.shape
+    # Truncate and scale the original image in place, then compute gradient
+    orig, pMin, pMax, zeros = preprocess_ima(orig, percMin=cfg.perc_min,
+                                             percMax=cfg.perc_max,
+                                             scale_factor=cfg.scale,
+                                             delta=0.0001,
+                                             approx=cfg.perc_approx)
+    gra = set_gradient_magnitude(orig, cfg.gramag, nr_threads=cfg.nr_threads)
+    # Compute 2D histogram and image to histogram mapping
+    counts, d_min, d_max, nr_bins, bin_edges, ima2volHistMap \
+        = prep_2D_hist(np.ravel(orig), np.ravel(gra),
+                       discard_zeros=cfg.discard_zeros,
+                       nr_threads=cfg.nr_threads, zeros=np.ravel(zeros))
+    ima2volHistMap = np.reshape(ima2volHistMap, dims)
+
+if cfg.use_cache and cached is None:
+    save_cache(cache_key, dict(zip(cache_names, [
+        orig, gra, counts, ima2volHistMap, [pMin, pMax, d_min, d_max]])))
+
 # Save min and max truncation thresholds to be used in axis labels
 orig_range = [pMin, pMax]
-# Continue with scaling the original truncated image and recomputing gradient
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
 if cfg.export_gramag:
     export_gradient_magnitude_image(gra, nii.get_filename(), nii.affine)
 
-# Reshape ima (more intuitive for voxel-wise operations)
-ima = np.ndarray.flatten(orig)
-gra = np.ndarray.flatten(gra)
-
 #
 """Plots"""
 # Plot 2D histogram
 fig = plt.figure(facecolor='0.775')
 ax = fig.add_subplot(121)
 
-counts, volHistH, d_min, d_max, nr_bins, bin_edges \
-    = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
+volHistH = ax.imshow(counts.T, cmap='Greys', origin='lower',
+                     interpolation='nearest', aspect='auto',
+                     extent=[d_min, d_max, d_min, d_max])
 
 ax.set_xlim(d_min, d_max)
 ax.set_ylim(d_min, d_max)
@@ -120,10 +142,10 @@ ncut_palette = plt.cm.gist_rainbow
 ncut_palette.set_under('w', 0)
 
 # Plot hist mask (with ncut labels)
-volHistMask = np.squeeze(ncut_labels[:, :, 0])
+volHistMask = ncut_labels.level(0).T  # transpose the labels
 volHistMaskH = ax.imshow(volHistMask, interpolation='none',
                          alpha=0.2, cmap=ncut_palette,
-                         vmin=np.min(ncut_labels)+1,  # to make 0 transparent
+                         vmin=ncut_labels.lMin+1,  # to make 0 transparent
                          vmax=lMax,
                          extent=[0, nr_bins, nr_bins, 0])
 
@@ -131,11 +153,11 @@ volHistMaskH = ax.imshow(volHistMask, interpolation='none',
 ax2 = fig.add_subplot(122)
 sliceNr = int(0.5*dims[2])
 imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray,
-                     vmin=ima.min(), vmax=ima.max(), interpolation='none',
+                     vmin=orig.min(), vmax=orig.max(), interpolation='none',
                      extent=[0, dims[1], dims[0], 0])
-imaSlcMsk = np.zeros(dims[0:2])*total_labels[1]
+imaSlcMsk = np.zeros(dims[0:2])
 imaSlcMskH = ax2.imshow(imaSlcMsk, interpolation='none', alpha=0.5,
-                        cmap=ncut_palette, vmin=np.min(ncut_labels)+1,
+                        cmap=ncut_palette, vmin=ncut_labels.lMin+1,
                         vmax=lMax,
                         extent=[0, dims[1], dims[0], 0])
 
@@ -150,25 +172,30 @@ plt.axis('off')
 """Initialisation"""
 # Initiate a flexible figure object, pass to it usefull properties
 flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
-                        segmType='ncut', orig=orig, nii=nii, ima=ima,
+                        segmType='ncut', orig=orig, nii=nii,
                         nrBins=nr_bins,
                         sliceNr=sliceNr,
                         imaSlcH=imaSlcH,
                         imaSlcMsk=imaSlcMsk, imaSlcMskH=imaSlcMskH,
+                        volHistH=volHistH,
                         volHistMask=volHistMask,
                         volHistMaskH=volHistMaskH,
                         pltMap=pltMap, pltMapH=pltMapH,
                         counterField=np.zeros((nr_bins, nr_bins)),
-                        orig_ncut_labels=orig_ncut_labels,
-                        ima_ncut_labels=ima_ncut_labels,
+                        ncut_labels=ncut_labels,
                         initTpl=(cfg.perc_min, cfg.perc_max, cfg.scale),
                         lMax=lMax)
 
 # Make the figure responsive to clicks
 flexFig.connect()
 # Get mapping from image slice to volume histogram
-ima2volHistMap = map_ima_to_2D_hist(xinput=ima, yinput=gra, bins_arr=bin_edges)
 flexFig.invHistVolume = np.reshape(ima2volHistMap, dims)
+if cfg.chunk_size > 0:  # inverted index does not fit into memory
+    flexFig.binPtr, flexFig.voxIdx = None, None
+    flexFig.scratchDir = scratch_dir
+else:
+    flexFig.binPtr, flexFig.voxIdx = create_bin_to_vox_index(ima2volHistMap,
+                                                             nr_bins)
 
 # %%
 """Sliders and Buttons"""
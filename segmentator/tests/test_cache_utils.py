@@ -0,0 +1,40 @@
+"""Test the persistent cache."""
+
+import os
+import numpy as np
+from segmentator.cache_utils import create_cache_key, load_cache
+from segmentator.cache_utils import save_cache, clear_cache
+
+
+def test_cache_roundtrip_and_eviction(tmpdir):
+    """Test cache keys, memory-mapped loading and LRU eviction."""
+    # Given
+    cache_dir = str(tmpdir.mkdir('cache'))
+    filename = str(tmpdir.join('ima.nii'))
+    with open(filename, 'wb') as f:
+        f.write(b'image content')
+    key_a = create_cache_key(filename, scale=400, gramag='scharr')
+    key_b = create_cache_key(filename, scale=500, gramag='scharr')
+    key_c = create_cache_key(filename, scale=600, gramag='scharr')
+    arrays = {'orig': np.random.random((10, 11, 12)), 'ranges': [0., 1.]}
+    max_size = 2.5 * arrays['orig'].nbytes / 2**30
+    # When
+    save_cache(key_a, arrays, cache_dir=cache_dir, max_size=max_size)
+    save_cache(key_b, arrays, cache_dir=cache_dir, max_size=max_size)
+    os.utime(os.path.join(cache_dir, key_a), (0, 0))
+    os.utime(os.path.join(cache_dir, key_b), (1, 1))
+    orig, ranges = load_cache(key_a, ['orig', 'ranges'], cache_dir=cache_dir)
+    save_cache(key_c, arrays, cache_dir=cache_dir, max_size=max_size)
+    # Then
+    assert key_a != key_b
+    assert key_a == create_cache_key(filename, gramag='scharr', scale=400)
+    assert isinstance(orig, np.memmap)
+    assert np.all(orig == arrays['orig'])
+    assert np.all(ranges == arrays['ranges'])
+    # the least recently used entry is evicted
+    assert load_cache(key_b, ['orig'], cache_dir=cache_dir) is None
+    assert load_cache(key_a, ['orig'], cache_dir=cache_dir) is not None
+    assert load_cache(key_c, ['orig'], cache_dir=cache_dir) is not None
+    del orig, ranges
+    clear_cache(cache_dir=cache_dir)
+    assert os.listdir(cache_dir) == []
@@ -0,0 +1,71 @@
+"""Test out-of-core (chunked) processing functions."""
+
+import numpy as np
+from segmentator.utils import truncate_range, scale_range, prep_2D_hist
+from segmentator.utils import compute_gradient_magnitude, preprocess_ima
+from segmentator.chunk_utils import chunked_percentile, truncate_range_chunked
+from segmentator.chunk_utils import scale_range_chunked, prep_2D_hist_chunked
+from segmentator.chunk_utils import compute_gradient_magnitude_chunked
+
+
+def test_chunked_percentile():
+    """Test exact percentiles computed slab by slab."""
+    # Given
+    data = np.random.randn(10, 11, 12)
+    data[data > 1.5] = 2.  # many identical values
+    data.ravel()[np.random.choice(data.size, 100, replace=False)] = 0
+    data.ravel()[np.random.choice(data.size, 10, replace=False)] = np.nan
+    percentiles = [0, 2.5, 50, 97.5, 100]
+    expected = np.nanpercentile(data[~np.isclose(data, 0)], percentiles)
+    # When
+    output = chunked_percentile(data, percentiles, 3, nr_hist_bins=16,
+                                max_collect=20)
+    # Then
+    assert np.allclose(output, expected)
+
+
+def test_chunked_preprocessing(tmpdir):
+    """Test chunked truncation, scaling, gradient and histogram."""
+    # Given
+    data = np.random.random((10, 11, 12)).astype(np.float32)
+    data[:2, ...] = 0
+    orig, _, _ = truncate_range(np.copy(data), percMin=2.5, percMax=97.5)
+    orig = scale_range(orig, scale_factor=50, delta=0.0001)
+    gra = compute_gradient_magnitude(orig)
+    counts, d_min, d_max, nr_bins, _, vox2pixMap = prep_2D_hist(
+        orig.flatten(), gra.flatten())
+    # When
+    orig_c, _, _ = truncate_range_chunked(np.copy(data), 4, percMin=2.5,
+                                          percMax=97.5)
+    orig_c = scale_range_chunked(orig_c, 4, scale_factor=50, delta=0.0001)
+    gra_c = compute_gradient_magnitude_chunked(
+        orig_c, np.zeros(data.shape, dtype=np.float32), 4, nr_threads=2)
+    counts_c, d_min_c, d_max_c, nr_bins_c, _, vox2pixMap_c = \
+        prep_2D_hist_chunked(orig_c, gra_c, str(tmpdir), 4)
+    # Then
+    assert np.allclose(orig_c, orig, atol=1e-4)
+    assert np.allclose(gra_c, gra, atol=1e-4)
+    assert (d_min_c, d_max_c, nr_bins_c) == (d_min, d_max, nr_bins)
+    # values close to bin edges may end up in neighbouring bins
+    assert np.mean(vox2pixMap_c.flatten() == vox2pixMap) > 0.99
+    assert np.sum(counts_c) == np.sum(counts)
+
+
+def test_preprocessed_hist_zeros(tmpdir):
+    """Test that voxels scaled to zero are discarded in both paths."""
+    # Given
+    data = np.random.random((20, 20, 20)).astype(np.float32) + 1
+    data[:2, ...] = 0
+    orig, _, _, zeros = preprocess_ima(np.copy(data), percMin=2.5,
+                                       percMax=97.5, delta=0.0001)
+    gra = compute_gradient_magnitude(orig)
+    counts = prep_2D_hist(np.ravel(orig), np.ravel(gra),
+                          zeros=np.ravel(zeros))[0]
+    # When
+    orig_c, _, _ = truncate_range_chunked(np.copy(data), 4, percMin=2.5,
+                                          percMax=97.5)
+    orig_c = scale_range_chunked(orig_c, 4, delta=0.0001)
+    counts_c = prep_2D_hist_chunked(orig_c, gra, str(tmpdir), 4)[0]
+    # Then
+    assert np.sum(counts) == np.sum(counts_c) == np.sum(orig > 1e-8)
+    assert np.sum(counts) < 18 * 20 * 20
@@ -0,0 +1,90 @@
+"""Test GUI utility classes."""
+
+import numpy as np
+from nibabel import Nifti1Image, load
+from segmentator.gui_utils import responsiveObj, sector_mask, sliceTransform
+
+
+def test_sector_mask():
+    """Test sector mask from the precomputed polar grid."""
+    # Given
+    shape = (40, 30)
+    x, y = np.ogrid[:shape[0], :shape[1]]
+    sector = sector_mask(shape, (0, 0), 10, (30, 300))
+    for centre, radius, rotation in [((0, 0), 10, 0), ((20, 15), 7.5, 45),
+                                     ((35, -5), 12, 200), ((-80, 90), 200, 0),
+                                     ((100, 100), 5, 0)]:
+        sector.set_x(centre[0])
+        sector.set_y(centre[1])
+        sector.set_r(radius)
+        sector.rotate(rotation)
+        theta = np.arctan2(x-centre[0], y-centre[1]) - sector.tmin
+        expected = (((x-centre[0])**2 + (y-centre[1])**2 <= radius**2)
+                    & (theta % (2*np.pi) <= sector.tmax - sector.tmin))
+        # When
+        output = sector.binaryMask()
+        # Then
+        assert output.dtype == bool
+        assert np.array_equal(output, expected)
+
+
+def test_slice_transform():
+    """Test display transform against rotated slices."""
+    # Given
+    slc = np.arange(20).reshape(4, 5)
+    for rotation in range(4):
+        expected = np.rot90(slc, rotation)
+        transform = sliceTransform(slc.shape, rotation)
+        # When
+        display = transform.displayData(slc)
+        left, right, bottom, top = transform.extent()
+        if left > right:
+            display = display[:, ::-1]
+        if top > bottom:
+            display = display[::-1, :]
+        # Then
+        assert transform.displayShape() == expected.shape
+        assert np.array_equal(display, expected)
+        for i in range(expected.shape[0]):
+            for j in range(expected.shape[1]):
+                row, col = transform.toArray(j + 0.5, i + 0.5)
+                assert slc[row, col] == expected[i, j]
+
+
+class labelExporter:
+    """Minimal stand-in for the export state of responsiveObj."""
+
+    def __init__(self, nii):
+        """Create the export message queue."""
+        try:
+            import queue
+        except ImportError:  # python 2
+            import Queue as queue
+        self.nii = nii
+        self.volLabels = None
+        self.exportMessages = queue.Queue()
+
+    def updateVolLabels(self, volHistMask):
+        """Label every voxel with the largest histogram label."""
+        self.volLabels = np.full(self.nii.shape, np.max(volHistMask),
+                                 dtype=np.uint8)
+
+
+def test_write_labels(tmpdir):
+    """Test exporting labels with the header of the input image."""
+    # Given
+    affine = np.diag([2., 3., 4., 1.])
+    nii = Nifti1Image(np.zeros((4, 5, 6), dtype=np.float32), affine=affine)
+    exporter = labelExporter(nii)
+    filename = str(tmpdir.join('labels.nii.gz'))
+    # When
+    responsiveObj.__dict__['writeLabels'](exporter, np.array([[0, 7]]),
+                                          filename, None)
+    # Then
+    assert exporter.exportMessages.get_nowait()[1] == 'labeling'
+    assert exporter.exportMessages.get_nowait()[1] == 'saving'
+    assert exporter.exportMessages.get_nowait()[1] == 'done'
+    output = load(filename)
+    assert np.allclose(output.affine, affine)
+    assert output.get_data_dtype() == np.uint8
+    assert np.all(np.asarray(output.dataobj) == 7)
@@ -0,0 +1,197 @@
+"""Test normalized graph cut functions."""
+
+import numpy as np
+import pytest
+from scipy import sparse
+from segmentator import ncut_utils
+from segmentator.ncut_utils import histogram_rag, ncut_hierarchy, ncut_sweep
+from segmentator.ncut_utils import ncut_superpixels
+from segmentator.ncut_utils import save_ncut_sweep, save_ncut_labels
+from segmentator.ncut_utils import load_ncut_labels, relabel_ncut_levels
+
+
+def same_partition(labels_a, labels_b):
+    """Check whether two label arrays describe the same partition."""
+    nr_pairs = len(set(zip(labels_a, labels_b)))
+    return nr_pairs == len(set(labels_a)) == len(set(labels_b))
+
+
+def expand_levels(tree):
+    """Expand all levels of an ncut label tree into a dense stack."""
+    return np.stack([tree.level(i) for i in range(tree.nrLevels)], axis=-1)
+
+
+def test_histogram_rag():
+    """Test the vectorized region adjacency graph against a pixel loop."""
+    # Given
+    image = np.random.random((20, 30))
+    labels = np.random.randint(0, 8, (4, 5)).repeat(5, 0).repeat(6, 1) + 3
+    edge_sigma, max_edge = 0.5, 2.
+    nodes = np.unique(labels)
+    means = np.array([np.mean(image[labels == n]) for n in nodes])
+    expected = np.diag(np.full(len(nodes), max_edge))
+    for i, j in np.ndindex(labels.shape):
+        for di, dj in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+            if not (0 <= i + di < 20 and 0 <= j + dj < 30):
+                continue
+            a = np.searchsorted(nodes, labels[i, j])
+            b = np.searchsorted(nodes, labels[i + di, j + dj])
+            if a != b:
+                expected[a, b] = expected[b, a] = np.exp(
+                    -(means[a] - means[b])**2 / edge_sigma)
+    # When
+    weights, output_nodes = histogram_rag(image, labels,
+                                          edge_sigma=edge_sigma,
+                                          max_edge=max_edge)
+    # Then
+    assert np.array_equal(output_nodes, nodes)
+    assert np.allclose(weights.toarray(), expected)
+
+
+def test_ncut_superpixels():
+    """Test grayscale superpixels against slic on the tiled uint8 image."""
+    # Given
+    slic = pytest.importorskip('skimage.segmentation').slic
+    image = np.log10(np.random.poisson(2, (100, 100)) + 1.)
+    image[10:40, 20:50] += 2.
+    image[60:90, 50:80] += 1.
+    image = np.round(255 / image.max() * image) / 255 * 3.
+    rgb = np.round(255 / image.max() * image).astype('uint8')
+    rgb = np.transpose(np.tile(rgb, (3, 1, 1)), (1, 2, 0))
+    for compactness in [2, 10]:
+        expected = slic(rgb, compactness=compactness, n_segments=200,
+                        sigma=2)
+        # When
+        labels1, _, _ = ncut_superpixels(image, compactness=compactness,
+                                         nrSupPix=200)
+        # Then
+        assert np.array_equal(labels1, expected)
+
+
+def test_ncut_hierarchy():
+    """Test that one pass records nested partitions for every level."""
+    # Given
+    # four dense clusters, pairs of clusters are moderately connected and
+    # the two pairs are weakly connected
+    nr_nodes = 40
+    cluster = np.arange(nr_nodes) // 10
+    weights = np.full((nr_nodes, nr_nodes), 1e-4)
+    weights[(cluster[:, None] // 2) == (cluster[None, :] // 2)] = 1e-2
+    weights[cluster[:, None] == cluster[None, :]] = 1.
+    weights = sparse.csr_matrix(weights)
+    # When
+    labels = ncut_hierarchy(weights, 3, thresh=0.1, num_cuts=100)
+    # Then
+    assert labels.shape == (nr_nodes, 4)
+    assert len(np.unique(labels[:, 0])) == 1
+    # every level refines the previous one
+    for level in range(1, labels.shape[1]):
+        for label in np.unique(labels[:, level]):
+            assert len(np.unique(labels[labels[:, level] == label,
+                                        level - 1])) == 1
+    # the weak connection is cut first, then the moderate connections
+    assert same_partition(labels[:, 1], cluster // 2)
+    assert same_partition(labels[:, 2], cluster)
+    assert np.array_equal(labels[:, 3], labels[:, 2])
+
+
+def fake_superpixels(image, compactness=2, nrSupPix=2000, edge_sigma=255.):
+    """Split an image into nrSupPix stripes, weakly linked stripe pairs."""
+    labels1 = np.floor(np.linspace(0, nrSupPix, image.shape[1],
+                                   endpoint=False)).astype(int)
+    labels1 = np.tile(labels1, (image.shape[0], 1))
+    links = np.where(np.arange(nrSupPix - 1) % 2, 1e-6 * compactness, 1.)
+    weights = sparse.diags(links, 1)
+    weights = weights + weights.T + sparse.identity(nrSupPix)
+    return labels1, weights.tocsr(), np.arange(nrSupPix)
+
+
+def test_ncut_sweep(tmpdir, monkeypatch):
+    """Test parallel parameter sweeps and the sweep archive."""
+    # Given
+    calls = []
+
+    def counted_superpixels(image, **kwargs):
+        calls.append(kwargs)
+        return fake_superpixels(image, **kwargs)
+
+    image = np.random.random((30, 40))
+    nr_sup_pix, compactness, max_rec = [8, 12], [1., 2.], [3, 1]
+    # When
+    monkeypatch.setattr(ncut_utils, 'ncut_superpixels', fake_superpixels)
+    results = ncut_sweep(image, nr_sup_pix, compactness, max_rec,
+                         nr_processes=2)
+    monkeypatch.setattr(ncut_utils, 'ncut_superpixels', counted_superpixels)
+    expected = ncut_sweep(image, nr_sup_pix, compactness, max_rec)
+    filename = str(tmpdir.join('sweep.npz'))
+    save_ncut_sweep(filename, results)
+    # Then
+    assert len(calls) == 4  # superpixels are shared between max_rec values
+    assert [r[:3] for r in results] == [
+        (sp, c, rec) for sp in nr_sup_pix for c in compactness
+        for rec in max_rec]
+    archive = np.load(filename)
+    for i, (sp, c, rec, tree) in enumerate(results):
+        labels = expand_levels(
+            load_ncut_labels(filename, prefix='ncut_' + str(i) + '_'))
+        assert labels.shape == (30, 40, rec + 1)
+        for name in tree:
+            assert np.array_equal(tree[name], expected[i][3][name])
+        assert (archive['nr_sup_pix'][i], archive['compactness'][i],
+                archive['max_rec'][i]) == (sp, c, rec)
+    labels = expand_levels(load_ncut_labels(filename, prefix='ncut_0_'))
+    assert len(np.unique(labels[..., -1])) > 1
+    with pytest.raises(ValueError) as err:
+        load_ncut_labels(filename)
+    assert '--ncut_entry' in str(err.value)
+    # lower recursion limits are prefixes of the deepest hierarchy
+    prefix_labels = expand_levels(load_ncut_labels(filename,
+                                                   prefix='ncut_1_'))
+    for level in range(2):
+        assert same_partition(prefix_labels[..., level].ravel(),
+                              labels[..., level].ravel())
+
+
+def test_ncut_labels_roundtrip(tmpdir):
+    """Test saving and loading ncut labels as a label tree."""
+    # Given
+    labels1 = np.random.randint(0, 64, (4, 5)).repeat(5, 0).repeat(6, 1)
+    weights = sparse.random(64, 64, density=0.2) + sparse.identity(64)
+    node_labels = ncut_hierarchy(weights + weights.T, 4, thresh=1.)
+    labels2 = node_labels[labels1] * 3 + 7  # arbitrary label values
+    filename = str(tmpdir.join('ncut.npz'))
+    legacy_filename = str(tmpdir.join('ncut.npy'))
+    # When
+    save_ncut_labels(filename, labels2, labels1)
+    output = load_ncut_labels(filename)
+    np.save(legacy_filename, labels2.astype(np.float64))
+    legacy_output = load_ncut_labels(legacy_filename)
+    # Then
+    assert np.load(filename)['superpixels'].dtype == np.uint16
+    assert output.nrLevels == labels2.shape[-1]
+    expected = relabel_ncut_levels(labels2)
+    assert np.array_equal(expand_levels(output), expected)
+    assert np.array_equal(expand_levels(legacy_output), expected)
+    assert (output.lMin, output.lMax) == (np.min(expected),
+                                          np.max(expected))
+
+
+def test_relabel_ncut_levels():
+    """Test vectorized relabeling against the per-label loop."""
+    # Given
+    labels2 = np.stack([np.random.randint(0, 2**i, (20, 30)) * 5 + 3
+                        for i in range(5)], axis=-1)
+    total_labels = np.arange(sum([2**x for x in range(5)]))
+    total_labels[1::2] = total_labels[-2:0:-2]
+    expected = np.zeros(labels2.shape)
+    counter = 0
+    for ind in range(5):
+        uniqueVals = np.unique(labels2[:, :, ind])
+        for ind2, val in enumerate(uniqueVals):
+            expected[:, :, ind][labels2[:, :, ind] == val] = \
+                total_labels[counter + ind2]
+        counter += len(uniqueVals)
+    # When
+    output = relabel_ncut_levels(labels2)
+    # Then
+    assert np.array_equal(output, expected)
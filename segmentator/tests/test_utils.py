@@ -1,7 +1,18 @@
 """Test utility functions."""
 
+import gzip
 import numpy as np
-from segmentator.utils import truncate_range, scale_range
+from nibabel import load, Nifti1Image
+from scipy.ndimage import convolve
+from segmentator.utils import truncate_range, scale_range, approx_percentile
+from segmentator.utils import load_float32_data, preprocess_ima
+from segmentator.utils import map_2D_hist_to_ima, create_2D_hist_lut
+from segmentator.utils import create_bin_to_vox_index
+from segmentator.utils import update_labels_from_bin_index
+from segmentator.utils import prep_2D_hist, compute_2D_hist_counts
+from segmentator.utils import create_3D_kernel, compute_gradient_magnitude
+from segmentator.utils import write_gzip_blocks, save_nifti
+from segmentator.utils import gzipBlockWriter
 
 
 def test_truncate_range():
@@ -19,6 +30,24 @@ def test_truncate_range():
     assert all(np.nanpercentile(output, [0, 100]) == expected)
 
 
+def test_approx_percentile():
+    """Test approximate percentiles."""
+    # Given
+    data = np.random.randn(1000)
+    data.ravel()[np.random.choice(data.size, 10, replace=False)] = 0
+    data.ravel()[np.random.choice(data.size, 5, replace=False)] = np.nan
+    percentiles = [0, 2.5, 50, 97.5, 100]
+    nr_hist_bins = 1000
+    values = data[~np.isclose(data, 0) & ~np.isnan(data)]
+    expected = np.percentile(values, percentiles)
+    # When
+    output = approx_percentile(data, percentiles, nr_hist_bins=nr_hist_bins,
+                               chunk_size=99)
+    # Then
+    bin_width = (np.max(values) - np.min(values)) / nr_hist_bins
+    assert np.all(np.abs(np.subtract(output, expected)) <= bin_width)
+
+
 def test_scale_range():
     """Test range scaling."""
     # Given
@@ -32,3 +61,183 @@ def test_scale_range():
     # Then
     assert all([np.nanmin(output) >= expected[0],
                 np.nanmax(output) < expected[1]])
+
+
+def test_load_float32_data(tmpdir):
+    """Test reading scaled nifti data as an uncached float32 array."""
+    # Given
+    data = np.random.randint(0, 1000, (10, 11, 1)).astype(np.int16)
+    img = Nifti1Image(data, affine=np.eye(4))
+    img.header.set_slope_inter(0.5, 2)
+    filename = str(tmpdir.join('data.nii'))
+    img.to_filename(filename)
+    nii = load(filename)
+    # When
+    output = load_float32_data(nii)
+    # Then
+    assert output.dtype == np.float32
+    assert output.shape == (10, 11)
+    assert np.allclose(output, 0.5 * data[..., 0] + 2)
+    assert not nii.in_memory
+
+
+def test_preprocess_ima():
+    """Test fused truncation and scaling."""
+    # Given
+    data = np.random.randint(0, 1000, (10, 11, 12)).astype(np.int16)
+    data[:2, ...] = 0
+    s = 42.  # scaling factor
+    # When
+    output, _, _, zeros = preprocess_ima(data, percMin=2.5, percMax=97.5,
+                                         scale_factor=s, delta=0.01)
+    # Then
+    assert output.dtype == np.float32
+    assert np.all(zeros[data == 0])
+    assert np.all(zeros == (output == 0))  # minimum is scaled to zero
+    assert np.any(zeros[data != 0])
+    assert np.isclose(np.max(output[~zeros]), s - 0.01)
+
+
+def test_map_2D_hist_to_ima():
+    """Test volume histogram to image mapping."""
+    # Given
+    nr_bins = 10
+    volHistMask = np.random.randint(0, 5, (nr_bins, nr_bins))
+    ima2volHistMap = np.random.randint(0, nr_bins*nr_bins, (4, 5, 6))
+    expected = np.zeros(ima2volHistMap.shape)
+    for idx in np.unique(volHistMask):
+        linIndices = np.where(volHistMask.flatten() == idx)[0]
+        expected[np.isin(ima2volHistMap, linIndices)] = idx
+    # When
+    output = map_2D_hist_to_ima(ima2volHistMap, volHistMask)
+    # Then
+    assert np.all(output == expected)
+
+
+def test_update_labels_from_bin_index():
+    """Test incremental labeling with the bin to voxel index."""
+    # Given
+    nr_bins = 10
+    ima2volHistMap = np.random.randint(0, nr_bins*nr_bins, (4, 5, 6))
+    bin_ptr, vox_idx = create_bin_to_vox_index(ima2volHistMap, nr_bins)
+    mask_old = np.random.randint(0, 3, (nr_bins, nr_bins))
+    mask_new = np.copy(mask_old)
+    mask_new[2:4, 5:8] = 7
+    labels = map_2D_hist_to_ima(ima2volHistMap, mask_old)
+    expected = map_2D_hist_to_ima(ima2volHistMap, mask_new)
+    # When
+    update_labels_from_bin_index(labels, create_2D_hist_lut(mask_old),
+                                 create_2D_hist_lut(mask_new),
+                                 bin_ptr, vox_idx)
+    # Then
+    assert np.all(labels == expected)
+
+
+def test_prep_2D_hist():
+    """Test 2D histogram counts and voxel to pixel mapping."""
+    # Given
+    ima = np.random.random(1000) * 50
+    gra = np.random.random(1000) * 60  # some voxels fall outside
+    ima[:10] = 0
+    # When
+    counts, d_min, d_max, nr_bins, bin_edges, vox2pixMap = prep_2D_hist(
+        ima, gra, discard_zeros=True)
+    # Then
+    expected, _, _ = np.histogram2d(ima[10:], gra[10:], bins=bin_edges)
+    assert np.all(counts == expected)
+    assert vox2pixMap.dtype == np.uint16
+    inside = (gra <= d_max) & (ima >= d_min) & (ima != 0)
+    assert np.all(vox2pixMap[~inside] == nr_bins*nr_bins)
+    assert np.all(vox2pixMap[inside] == (
+        np.floor(gra[inside] - d_min) * nr_bins
+        + np.floor(ima[inside] - d_min)))
+
+
+def test_compute_2D_hist_counts_threads():
+    """Test chunked and threaded histogram counting."""
+    # Given
+    nr_bins = 20
+    vox2pixMap = np.random.randint(0, nr_bins*nr_bins+1, 10000)
+    msk = np.random.random(10000) > 0.3
+    expected = compute_2D_hist_counts(vox2pixMap, nr_bins, msk=msk)
+    # When
+    output = compute_2D_hist_counts(vox2pixMap, nr_bins, msk=msk,
+                                    nr_threads=3, chunk_size=999)
+    # Then
+    assert np.all(output == expected)
+    assert np.sum(output) == np.sum(vox2pixMap[msk] < nr_bins*nr_bins)
+
+
+def test_compute_gradient_magnitude():
+    """Test separable gradient magnitude against full 3D kernels."""
+    # Given
+    ima = np.random.random((12, 13, 14))
+    for method in ['scharr', 'sobel', 'prewitt']:
+        kernel = create_3D_kernel(operator=method)
+        gra = [convolve(ima, kernel[d, ...]) for d in range(kernel.shape[0])]
+        expected = np.sqrt(np.sum(np.power(gra, 2.), axis=0))
+        # When
+        output = compute_gradient_magnitude(ima, method=method)
+        # Then
+        assert output.dtype == np.float32
+        assert np.allclose(output, expected, rtol=1e-4, atol=1e-6)
+
+
+def test_compute_gradient_magnitude_threads():
+    """Test that slab parallel gradient magnitude is identical to serial."""
+    # Given
+    ima = np.random.random((12, 13, 14))
+    for method in ['scharr', 'numpy']:
+        expected = compute_gradient_magnitude(ima, method=method)
+        # When
+        output = compute_gradient_magnitude(ima, method=method, nr_threads=4)
+        # Then
+        assert np.array_equal(output, expected)
+
+
+def test_write_gzip_blocks(tmpdir):
+    """Test block parallel gzip compression."""
+    # Given
+    data = np.random.randint(0, 5, 10000).astype(np.uint8).tobytes()
+    filename = str(tmpdir.join('data.gz'))
+    # When
+    write_gzip_blocks(data, filename, gzip_level=6, nr_threads=3,
+                      block_size=999)
+    # Then
+    with gzip.open(filename, 'rb') as f:
+        assert f.read() == data
+
+
+def test_gzip_block_writer(tmpdir):
+    """Test that streamed writes keep a bounded number of blocks."""
+    # Given
+    data = np.random.randint(0, 5, (40, 250)).astype(np.uint8)
+    filename = str(tmpdir.join('data.gz'))
+    nr_pending = []
+    # When
+    with open(filename, 'wb') as f:
+        writer = gzipBlockWriter(f, nr_threads=2, block_size=999)
+        for row in data:
+            writer.write(row.tobytes())
+            nr_pending.append(len(writer.pending))
+            assert writer.nrBuffered < 999
+        writer.close()
+    # Then
+    assert max(nr_pending) == 2
+    with gzip.open(filename, 'rb') as f:
+        assert f.read() == data.tobytes()
+
+
+def test_save_nifti(tmpdir):
+    """Test saving compressed and uncompressed nifti files."""
+    # Given
+    data = np.random.randint(0, 300, (10, 11, 12)).astype(np.uint16)
+    img = Nifti1Image(data, affine=np.eye(4))
+    for ext in ['.nii', '.nii.gz']:
+        filename = str(tmpdir.join('labels' + ext))
+        # When
+        save_nifti(img, filename, nr_threads=2)
+        # Then
+        output = load(filename)
+        assert output.get_data_dtype() == np.uint16
+        assert np.array_equal(np.asarray(output.dataobj), data)
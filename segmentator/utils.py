@@ -19,12 +19,14 @@
 
 from __future__ import division
 import os
+import zlib
 import numpy as np
 import warnings
-import matplotlib.pyplot as plt
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import config as cfg
 from nibabel import load, Nifti1Image, save
-from scipy.ndimage import convolve
+from scipy.ndimage import convolve1d
 
 
 def sub2ind(array_shape, rows, cols):
@@ -45,7 +47,58 @@ def sub2ind(array_shape, rows, cols):
     return (cols*array_shape + rows)
 
 
-def map_ima_to_2D_hist(xinput, yinput, bins_arr):
+def bin_unit_spaced(data, d_min, nr_bins):
+    """Find bin indices of unit spaced bins arithmetically.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Values to be binned.
+    d_min : float
+        Left edge of the first bin.
+    nr_bins : integer
+        Number of bins. Bin edges are np.arange(d_min, d_min + nr_bins + 1).
+
+    Returns
+    -------
+    idx : np.ndarray
+        Bin index of every value. Values outside of the bin edges (and nans)
+        are marked with -1. Similar to numpy histograms, the last bin also
+        includes its right edge.
+
+    """
+    idx = np.subtract(data, d_min, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        outside = ~((idx >= 0) & (idx <= nr_bins))
+    idx[outside] = 0
+    np.floor(idx, out=idx)
+    np.minimum(idx, nr_bins - 1, out=idx)
+    idx = idx.astype(np.int64)
+    idx[outside] = -1
+    return idx
+
+
+def get_bin_index_dtype(nr_bins):
+    """Return the compact integer type of linear histogram bin indices.
+
+    Parameters
+    ----------
+    nr_bins : integer
+        Number of one dimensional bins (not the pixels).
+
+    Returns
+    -------
+    dtype : np.uint16 or np.uint32
+        Smallest type that holds nr_bins*nr_bins, the index of the voxels
+        outside of the histogram.
+
+    """
+    if nr_bins*nr_bins <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def map_ima_to_2D_hist(xinput, yinput, bins_arr, chunk_size=2**22):
     """Image to volume histogram mapping (kind of inverse histogram).
 
     Parameters
@@ -56,61 +109,298 @@ def map_ima_to_2D_hist(xinput, yinput, bins_arr):
         Second image, which is often the gradient magnitude image
         derived from the first image.
     bins_arr : TODO
-        Array of bins.
+        Array of unit spaced bins.
+    chunk_size : integer
+        Number of voxels binned at once, limits the temporary memory.
 
     Returns
     -------
     vox2pixMap : TODO
-        Voxel to pixel mapping.
+        Voxel to pixel mapping, same shape as xinput, with the type from
+        get_bin_index_dtype. Voxels outside of the histogram are mapped to
+        nr_bins*nr_bins (one after the last pixel).
+
+    Notes
+    -----
+    Bins are computed arithmetically instead of a binary search per voxel.
 
     """
-    dgtzData = np.digitize(xinput, bins_arr)-1
-    dgtzGra = np.digitize(yinput, bins_arr)-1
     nr_bins = len(bins_arr)-1  # subtract 1 (more borders than containers)
-    vox2pixMap = sub2ind(nr_bins, dgtzData, dgtzGra)  # 1D
-    return vox2pixMap
+    shape = np.shape(xinput)
+    xinput, yinput = np.ravel(xinput), np.ravel(yinput)
+    vox2pixMap = np.empty(xinput.shape, dtype=get_bin_index_dtype(nr_bins))
+    for i in range(0, xinput.size, chunk_size):
+        dgtzData = bin_unit_spaced(xinput[i:i+chunk_size], bins_arr[0],
+                                   nr_bins)
+        dgtzGra = bin_unit_spaced(yinput[i:i+chunk_size], bins_arr[0],
+                                  nr_bins)
+        chunk = sub2ind(nr_bins, dgtzData, dgtzGra)
+        chunk[(dgtzData < 0) | (dgtzGra < 0)] = nr_bins*nr_bins
+        vox2pixMap[i:i+chunk_size] = chunk
+    return vox2pixMap.reshape(shape)
+
+
+def create_2D_hist_lut(volHistMask, discard_zeros=False):
+    """Flatten volume histogram mask into a lookup table.
 
+    Parameters
+    ----------
+    volHistMask : 2D numpy array
+        Volume histogram mask.
+    discard_zeros : bool
+        Do not label voxels that fall into the first histogram bin.
 
-def map_2D_hist_to_ima(imaSlc2volHistMap, volHistMask):
-    """Volume histogram to image mapping for slices (uses np.ind1).
+    Returns
+    -------
+    lut : 1D numpy array
+        Labels of the linear histogram bin indices. The extra last element
+        holds the label (always 0) for bin indices outside of the histogram.
+
+    """
+    lut = np.zeros(volHistMask.size + 1)  # last element is for outliers
+    lut[:-1] = volHistMask.flat
+    if discard_zeros:
+        lut[0] = 0
+    return lut
+
+
+def map_2D_hist_to_ima(imaSlc2volHistMap, volHistMask, discard_zeros=False):
+    """Volume histogram to image mapping using a lookup table.
 
     Parameters
     ----------
-    imaSlc2volHistMap : 1D numpy array
-        Flattened image slice.
-    volHistMask : 1D numpy array
-        Flattened volume histogram mask.
+    imaSlc2volHistMap : numpy array
+        Linear histogram bin index of every voxel (any shape, e.g. a slice or
+        the whole volume).
+    volHistMask : 2D numpy array
+        Volume histogram mask. Its flattened form is used as a lookup table
+        from linear bin indices to labels.
+    discard_zeros : bool
+        Do not label voxels that fall into the first histogram bin.
 
     Returns
     -------
-    imaSlcMask : 1D numpy array
-        Flat image slice mask based on labeled pixels in volume histogram.
+    imaSlcMask : numpy array
+        Mask with the same shape as imaSlc2volHistMap, based on labeled pixels
+        in volume histogram.
+
+    Notes
+    -----
+    Every voxel is labeled with one gather operation, so the cost does not
+    depend on the number of labels. Bin indices that fall outside of the
+    histogram are labeled with 0.
 
     """
-    imaSlcMask = np.zeros(imaSlc2volHistMap.shape)
-    idxUnique = np.unique(volHistMask)
-    for idx in idxUnique:
-        linIndices = np.where(volHistMask.flatten() == idx)[0]
-        # return logical array with length equal to nr of voxels
-        voxMask = np.in1d(imaSlc2volHistMap, linIndices)
-        # reset mask and apply logical indexing
-        imaSlcMask[voxMask] = idx
+    lut = create_2D_hist_lut(volHistMask, discard_zeros=discard_zeros)
+    imaSlcMask = np.take(lut, imaSlc2volHistMap, mode='clip')
     return imaSlcMask
 
 
-def truncate_range(data, percMin=0.25, percMax=99.75, discard_zeros=True):
+def create_bin_to_vox_index(ima2volHistMap, nr_bins):
+    """Create an inverted index from histogram bins to voxels.
+
+    Parameters
+    ----------
+    ima2volHistMap : numpy array
+        Linear histogram bin index of every voxel.
+    nr_bins : integer
+        Number of one dimensional bins (not the pixels).
+
+    Returns
+    -------
+    bin_ptr : 1D numpy array, shape(nr_bins*nr_bins + 2)
+        Voxels of bin i are vox_idx[bin_ptr[i]:bin_ptr[i+1]] (CSR format).
+        The last bin collects the voxels that are outside of the histogram.
+    vox_idx : 1D numpy array
+        Flat (C order) voxel indices sorted by their histogram bin. Stored as
+        uint32 unless the volume has more voxels.
+
+    """
+    nr_pix = nr_bins*nr_bins + 1  # +1 for outliers, same as in the lut
+    ima2volHistMap = np.clip(np.ravel(ima2volHistMap), 0, nr_pix-1)
+    vox_idx = np.argsort(ima2volHistMap, kind='mergesort')
+    if vox_idx.size <= np.iinfo(np.uint32).max:
+        vox_idx = vox_idx.astype(np.uint32)
+    bin_ptr = np.zeros(nr_pix+1, dtype=np.int64)
+    np.cumsum(np.bincount(ima2volHistMap, minlength=nr_pix), out=bin_ptr[1:])
+    return bin_ptr, vox_idx
+
+
+def update_labels_from_bin_index(labels, lut_old, lut_new, bin_ptr, vox_idx):
+    """Patch a label volume only at voxels whose bins changed their label.
+
+    Parameters
+    ----------
+    labels : numpy array
+        Label volume, which was created with lut_old. Modified in place.
+    lut_old : 1D numpy array
+        Lookup table (see create_2D_hist_lut) that labels currently reflects.
+    lut_new : 1D numpy array
+        New lookup table.
+    bin_ptr, vox_idx : 1D numpy arrays
+        Inverted index from create_bin_to_vox_index.
+
+    Returns
+    -------
+    nr_vox : integer
+        Number of voxels that are updated.
+
+    """
+    changed = np.flatnonzero(lut_old != lut_new)
+    starts = bin_ptr[changed]
+    lengths = bin_ptr[changed+1] - starts
+    nr_vox = int(np.sum(lengths))
+    if nr_vox > 0:
+        # concatenate the voxel ranges of all changed bins without a loop
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        vox = vox_idx[offsets + np.arange(nr_vox)]
+        labels.flat[vox] = np.repeat(lut_new[changed], lengths)
+    return nr_vox
+
+
+def approx_percentile(data, percentiles, discard_zeros=True,
+                      nr_hist_bins=2**16, chunk_size=2**22):
+    """Approximate percentiles from a fine grained streaming histogram.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image data (can be memory-mapped).
+    percentiles : list
+        Percentiles in range [0, 100].
+    discard_zeros : bool
+        Discard voxels with value 0.
+    nr_hist_bins : integer
+        Number of histogram bins. Determines the accuracy.
+    chunk_size : integer
+        Number of voxels processed at once.
+
+    Returns
+    -------
+    values : list
+        Percentile values. The error is smaller than one histogram bin, which
+        is (max - min) / nr_hist_bins.
+
+    Notes
+    -----
+    Data is read twice in chunks (once for the range, once for the
+    histogram), memory use does not depend on the data size.
+
+    """
+    flat = data.reshape(-1)
+
+    def iter_chunks():
+        for i in range(0, flat.size, chunk_size):
+            chunk = np.asarray(flat[i:i+chunk_size])
+            valid = ~np.isnan(chunk)
+            if discard_zeros:
+                valid &= ~get_zero_mask(chunk)
+            yield chunk[valid]
+
+    nr_values, d_min, d_max = 0, np.inf, -np.inf
+    for chunk in iter_chunks():
+        if chunk.size > 0:
+            nr_values += chunk.size
+            d_min = min(d_min, np.min(chunk))
+            d_max = max(d_max, np.max(chunk))
+    counts = np.zeros(nr_hist_bins, dtype=np.int64)
+    for chunk in iter_chunks():
+        counts += np.histogram(chunk, bins=nr_hist_bins,
+                               range=(d_min, d_max))[0]
+    cumsum = np.cumsum(counts)
+    bin_width = (d_max - d_min) / nr_hist_bins
+
+    def value_at_rank(rank):
+        if rank <= 0:
+            return d_min
+        elif rank >= nr_values - 1:
+            return d_max
+        b = int(np.searchsorted(cumsum, rank, side='right'))
+        below = cumsum[b] - counts[b]
+        # assume values are evenly spread within the bin
+        return d_min + bin_width * (b + (rank - below + 0.5) / counts[b])
+
+    values = []
+    for p in percentiles:
+        rank = p / 100. * (nr_values - 1)  # linear interpolation as numpy
+        lower = value_at_rank(int(np.floor(rank)))
+        upper = value_at_rank(int(np.ceil(rank)))
+        values.append(lower + (upper - lower) * (rank - np.floor(rank)))
+    return values
+
+
+def get_zero_mask(data, atol=1e-8, out=None):
+    """Find voxels which are close to zero.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image data.
+    atol : float
+        Absolute tolerance, same as np.isclose.
+    out : np.ndarray, bool
+        Array to store the mask in, same shape as data. Allocated if None.
+
+    Returns
+    -------
+    zeros : np.ndarray, bool
+        Same as np.isclose(data, 0), without float temporaries.
+
+    """
+    zeros = np.greater_equal(data, -atol, out=out)
+    zeros &= np.less_equal(data, atol)
+    return zeros
+
+
+def nanrange(data, exclude=None, chunk_size=2**22):
+    """Minimum and maximum ignoring nans and excluded voxels.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image data.
+    exclude : np.ndarray, bool
+        Voxels to ignore, same shape as data.
+    chunk_size : integer
+        Number of voxels processed at once, limits the size of temporaries.
+
+    Returns
+    -------
+    d_min, d_max : float
+
+    """
+    if exclude is None:
+        return np.nanmin(data), np.nanmax(data)
+    data, exclude = np.ravel(data), np.ravel(exclude)
+    d_min, d_max = np.inf, -np.inf
+    for i in range(0, data.size, chunk_size):
+        chunk = data[i:i+chunk_size][~exclude[i:i+chunk_size]]
+        chunk = chunk[~np.isnan(chunk)]
+        if chunk.size > 0:
+            d_min = min(d_min, np.min(chunk))
+            d_max = max(d_max, np.max(chunk))
+    return d_min, d_max
+
+
+def truncate_range(data, percMin=0.25, percMax=99.75, discard_zeros=True,
+                   approx=False, zeros=None):
     """Truncate too low and too high values.
 
     Parameters
     ----------
     data : np.ndarray
-        Image to be truncated.
+        Image to be truncated. Modified in place.
     percMin : float
         Percentile minimum.
     percMax : float
         Percentile maximum.
     discard_zeros : bool
         Discard voxels with value 0 from truncation.
+    approx : bool
+        Use approximate percentiles (see approx_percentile), which do not
+        need to sort the data.
+    zeros : np.ndarray, bool
+        Precomputed zero mask (see get_zero_mask). Computed if None.
 
     Returns
     -------
@@ -122,26 +412,29 @@ def truncate_range(data, percMin=0.25, percMax=99.75, discard_zeros=True):
         Maximum truncation threshold which is used.
 
     """
-    if discard_zeros:
-        msk = ~np.isclose(data, 0.)
-        pMin, pMax = np.nanpercentile(data[msk], [percMin, percMax])
+    if discard_zeros and zeros is None:
+        zeros = get_zero_mask(data)
+    if approx:
+        pMin, pMax = approx_percentile(data, [percMin, percMax],
+                                       discard_zeros=discard_zeros)
+    elif discard_zeros:
+        pMin, pMax = np.nanpercentile(data[~zeros], [percMin, percMax])
     else:
         pMin, pMax = np.nanpercentile(data, [percMin, percMax])
-    temp = data[~np.isnan(data)]
-    temp[temp < pMin], temp[temp > pMax] = pMin, pMax  # truncate min and max
-    data[~np.isnan(data)] = temp
+    np.clip(data, pMin, pMax, out=data)  # truncate min and max, keeps nans
     if discard_zeros:
-        data[~msk] = 0  # put back masked out voxels
+        np.copyto(data, 0, where=zeros)  # put back masked out voxels
     return data, pMin, pMax
 
 
-def scale_range(data, scale_factor=500, delta=0, discard_zeros=True):
+def scale_range(data, scale_factor=500, delta=0, discard_zeros=True,
+                zeros=None):
     """Scale values as a preprocessing step.
 
     Parameters
     ----------
     data : np.ndarray
-        Image to be scaled.
+        Image to be scaled. Modified in place.
     scale_factor : float
         Lower scaleFactors provides faster interface due to loweing the
         resolution of 2D histogram ( 500 seems fast enough).
@@ -150,6 +443,8 @@ def scale_range(data, scale_factor=500, delta=0, discard_zeros=True):
         when this function is used with histograms.
     discard_zeros : bool
         Discard voxels with value 0 from truncation.
+    zeros : np.ndarray, bool
+        Precomputed zero mask (see get_zero_mask). Computed if None.
 
     Returns
     -------
@@ -157,19 +452,130 @@ def scale_range(data, scale_factor=500, delta=0, discard_zeros=True):
         Scaled image.
 
     """
+    if discard_zeros and zeros is None:
+        zeros = get_zero_mask(data)
+    d_min, d_max = nanrange(data, exclude=zeros if discard_zeros else None)
+    data -= d_min
+    data *= (scale_factor - delta) / (d_max - d_min)
     if discard_zeros:
-        msk = ~np.isclose(data, 0)
-    else:
-        msk = np.ones(data.shape, dtype=bool)
-    scale_factor = scale_factor - delta
-    data[msk] = data[msk] - np.nanmin(data[msk])
-    data[msk] = scale_factor / np.nanmax(data[msk]) * data[msk]
-    if discard_zeros:
-        data[~msk] = 0  # put back masked out voxels
+        np.copyto(data, 0, where=zeros)  # put back masked out voxels
     return data
 
 
-def prep_2D_hist(ima, gra, discard_zeros=True):
+def load_float32_data(nii):
+    """Read nifti image data as a float32 array.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Loaded nifti image.
+
+    Returns
+    -------
+    data : np.ndarray, float32
+        Squeezed image data, which nibabel does not cache. preprocess_ima
+        can modify it in place without making another copy.
+
+    """
+    return np.squeeze(np.asarray(nii.dataobj[...], dtype=np.float32))
+
+
+def preprocess_ima(data, percMin=0.25, percMax=99.75, scale_factor=500,
+                   delta=0, discard_zeros=True, approx=False):
+    """Truncate and scale an image in place, sharing one zero mask.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image to be preprocessed. Modified in place if it is a float32
+        array, other types are converted to float32.
+    percMin, percMax, approx :
+        See truncate_range.
+    scale_factor, delta :
+        See scale_range.
+    discard_zeros : bool
+        Discard voxels with value 0 from truncation and scaling.
+
+    Returns
+    -------
+    data : np.ndarray, float32
+        Truncated and scaled image.
+    pMin, pMax : float
+        Minimum and maximum truncation thresholds which are used.
+    zeros : np.ndarray, bool or None
+        Zero mask of the scaled image, which can be passed on to
+        prep_2D_hist. Besides the discarded voxels, it contains the voxels
+        which are scaled to zero, as if prep_2D_hist computed it itself.
+
+    Notes
+    -----
+    Apart from the percentile computation (see approx_percentile to avoid
+    it), only one boolean volume is allocated.
+
+    """
+    if data.dtype != np.float32:
+        data = data.astype(np.float32)
+    zeros = get_zero_mask(data) if discard_zeros else None
+    data, pMin, pMax = truncate_range(data, percMin=percMin, percMax=percMax,
+                                      discard_zeros=discard_zeros,
+                                      approx=approx, zeros=zeros)
+    data = scale_range(data, scale_factor=scale_factor, delta=delta,
+                       discard_zeros=discard_zeros, zeros=zeros)
+    if discard_zeros:  # the minimum is scaled to zero as well
+        zeros = get_zero_mask(data, out=zeros)
+    return data, pMin, pMax, zeros
+
+
+def compute_2D_hist_counts(vox2pixMap, nr_bins, msk=None, nr_threads=1,
+                           chunk_size=2**22):
+    """Count voxels in every 2D histogram pixel.
+
+    Parameters
+    ----------
+    vox2pixMap : np.ndarray
+        Voxel to pixel mapping (see map_ima_to_2D_hist).
+    nr_bins : integer
+        Number of one dimensional bins (not the pixels).
+    msk : np.ndarray, bool
+        Only voxels within this mask are counted. All voxels by default.
+    nr_threads : integer
+        Number of threads used to count the chunks.
+    chunk_size : integer
+        Number of voxels counted at once.
+
+    Returns
+    -------
+    counts : np.ndarray, shape(nr_bins, nr_bins)
+        Histogram counts, first axis is the first image (eg. intensity) as in
+        np.histogram2d. Voxels outside of the histogram are not counted.
+
+    """
+    nr_pix = nr_bins*nr_bins + 1  # +1 for outliers
+    vox2pixMap = np.ravel(vox2pixMap)
+    if msk is not None:
+        msk = np.ravel(msk)
+
+    def count_chunk(i):
+        chunk = vox2pixMap[i:i+chunk_size]
+        if msk is not None:
+            chunk = chunk[msk[i:i+chunk_size]]
+        return np.bincount(chunk, minlength=nr_pix)
+
+    chunk_starts = range(0, vox2pixMap.size, chunk_size)
+    counts = np.zeros(nr_pix, dtype=np.int64)
+    if nr_threads > 1:
+        pool = ThreadPool(nr_threads)
+        for chunk_counts in pool.imap_unordered(count_chunk, chunk_starts):
+            counts += chunk_counts
+        pool.close()
+        pool.join()
+    else:
+        for i in chunk_starts:
+            counts += count_chunk(i)
+    return counts[:-1].reshape(nr_bins, nr_bins).T
+
+
+def prep_2D_hist(ima, gra, discard_zeros=True, nr_threads=1, zeros=None):
     """Prepare 2D histogram related variables.
 
     Parameters
@@ -179,11 +585,16 @@ def prep_2D_hist(ima, gra, discard_zeros=True):
     gra : np.ndarray
         Second image, which is often the gradient magnitude image
         derived from the first image.
+    discard_zeros : bool
+        Discard voxels with value 0 from the histogram.
+    nr_threads : integer
+        Number of threads used to count the histogram.
+    zeros : np.ndarray, bool
+        Precomputed zero mask of ima (see preprocess_ima). Computed if None.
 
     Returns
     -------
     counts : integer
-    volHistH : TODO
     d_min : float
         Minimum of the first image.
     d_max : float
@@ -191,20 +602,32 @@ def prep_2D_hist(ima, gra, discard_zeros=True):
     nr_bins : integer
         Number of one dimensional bins (not the pixels).
     bin_edges : TODO
+    vox2pixMap : np.ndarray
+        Voxel to pixel mapping (see map_ima_to_2D_hist). Discarded zero
+        voxels are mapped outside of the histogram.
 
     Notes
     -----
-    This function is modularized to be called from the terminal.
+    This function is modularized to be called from the terminal. Voxels are
+    binned only once, both the counts and the voxel to pixel mapping are
+    derived from the same bins. No plotting library is used here, the GUI
+    displays the counts itself.
 
     """
     if discard_zeros:
-        gra = gra[~np.isclose(ima, 0)]
-        ima = ima[~np.isclose(ima, 0)]
-    d_min, d_max = np.round(np.nanpercentile(ima, [0, 100]))
+        if zeros is None:
+            zeros = get_zero_mask(ima)
+        d_min, d_max = np.round(nanrange(ima, exclude=zeros))
+    else:
+        d_min, d_max = np.round(nanrange(ima))
     nr_bins = int(d_max - d_min)
     bin_edges = np.arange(d_min, d_max+1)
-    counts, _, _, volHistH = plt.hist2d(ima, gra, bins=bin_edges, cmap='Greys')
-    return counts, volHistH, d_min, d_max, nr_bins, bin_edges
+    vox2pixMap = map_ima_to_2D_hist(ima, gra, bin_edges)
+    if discard_zeros:
+        np.copyto(vox2pixMap, nr_bins*nr_bins, where=zeros)
+    counts = compute_2D_hist_counts(vox2pixMap, nr_bins,
+                                    nr_threads=nr_threads)
+    return counts, d_min, d_max, nr_bins, bin_edges, vox2pixMap
 
 
 def create_3D_kernel(operator='sobel'):
@@ -249,7 +672,85 @@ def create_3D_kernel(operator='sobel'):
     return kernel
 
 
-def compute_gradient_magnitude(ima, method='scharr'):
+def create_separable_kernel(operator='scharr'):
+    """Create 1D kernels of separable 3D gradient operators.
+
+    Parameters
+    ----------
+    operator : string
+        Input can be 'sobel', 'prewitt' or 'scharr'.
+
+    Returns
+    -------
+    smooth : np.ndarray, shape(3,)
+        Smoothing kernel, applied along the axes orthogonal to the gradient.
+    diff : np.ndarray, shape(3,)
+        Differencing kernel, applied along the gradient axis.
+
+    Notes
+    -----
+    The outer product of diff, smooth and smooth is equal to the first kernel
+    of create_3D_kernel.
+
+    """
+    if operator == 'sobel':
+        smooth = np.array([1, 2, 1], dtype=np.float32)
+    elif operator == 'prewitt':
+        smooth = np.array([1, 1, 1], dtype=np.float32)
+    elif operator == 'scharr':
+        smooth = np.array([3, 10, 3], dtype=np.float32)
+    smooth /= np.sum(smooth)
+    diff = np.array([1, 0, -1], dtype=np.float32) / 2
+    return smooth, diff
+
+
+def gradient_magnitude_slab(ima, gra_mag, slab, method='scharr'):
+    """Compute gradient magnitude of a slab along the last axis.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        First image, which is often the intensity image (eg. T1w).
+    gra_mag : np.ndarray, float32
+        Output gradient magnitude image, written in place within the slab.
+    slab : tuple
+        First and last (exclusive) index of the slab along the last axis.
+    method : string
+        Gradient computation method. Available options are 'scharr',
+        'sobel', 'prewitt', 'numpy'.
+
+    Notes
+    -----
+    The slab is padded with a one voxel halo (except at the borders of the
+    image), so the result does not depend on how the image is split.
+
+    """
+    z0, z1 = slab
+    h0, h1 = max(z0-1, 0), min(z1+1, ima.shape[-1])
+    block = np.asarray(ima[..., h0:h1], dtype=np.float32)
+    block_mag = np.zeros(block.shape, dtype=np.float32)
+    if method in ['sobel', 'prewitt', 'scharr']:
+        smooth, diff = create_separable_kernel(operator=method)
+        temp1, temp2 = np.empty_like(block_mag), np.empty_like(block_mag)
+        for d in range(block.ndim):
+            # differencing along one axis, smoothing along the others
+            convolve1d(block, diff, axis=d, output=temp1)
+            for s in range(block.ndim):
+                if s != d:
+                    convolve1d(temp1, smooth, axis=s, output=temp2)
+                    temp1, temp2 = temp2, temp1
+            np.square(temp1, out=temp1)
+            block_mag += temp1
+        # mirrored kernels give the same responses with opposite sign
+        block_mag *= 2
+    elif method == 'numpy':
+        for d in range(block.ndim):
+            block_mag += np.square(np.gradient(block, axis=d))
+    np.sqrt(block_mag, out=block_mag)
+    gra_mag[..., z0:z1] = block_mag[..., z0-h0:z1-h0]
+
+
+def compute_gradient_magnitude(ima, method='scharr', nr_threads=1):
     """Compute gradient magnitude of images.
 
     Parameters
@@ -259,46 +760,49 @@ def compute_gradient_magnitude(ima, method='scharr'):
     method : string
         Gradient computation method. Available options are 'scharr',
         'sobel', 'prewitt', 'numpy'.
+    nr_threads : integer
+        Number of threads. The image is split into this many slabs along the
+        last axis, which are processed concurrently.
+
     Returns
     -------
-    gra_mag : np.ndarray
+    gra_mag : np.ndarray, float32
         Second image, which is often the gradient magnitude image
         derived from the first image
 
+    Notes
+    -----
+    Kernel based methods use the separable form of the 3D operators, which
+    gives the same result as six full 3D convolutions (see create_3D_kernel).
+    The squared magnitude is accumulated in place in float32. The result is
+    identical for any number of threads.
+
     """
-    if method.lower() == 'sobel':  # magnitude scale is similar to numpy method
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1))
-        return gra_mag
-    elif method.lower() == 'prewitt':
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1))
-        return gra_mag
-    elif method.lower() == 'scharr':
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1))
-        return gra_mag
-    elif method.lower() == 'numpy':
-        gra = np.asarray(np.gradient(ima))
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=0))
-        return gra_mag
-    else:
+    method = method.lower()
+    if method not in cfg.gramag_options:
         print('Gradient magnitude method is invalid!')
+        return
+    gra_mag = np.zeros(ima.shape, dtype=np.float32)
+    nr_slabs = max(min(nr_threads, ima.shape[-1]), 1)
+    edges = np.linspace(0, ima.shape[-1], nr_slabs+1).astype(int)
+    slabs = zip(edges[:-1], edges[1:])
+
+    def compute_slab(slab):
+        gradient_magnitude_slab(ima, gra_mag, slab, method=method)
+
+    if nr_slabs > 1:
+        # scipy.ndimage releases the GIL, so threads run concurrently
+        pool = ThreadPool(nr_threads)
+        pool.map(compute_slab, slabs)
+        pool.close()
+        pool.join()
+    else:
+        for slab in slabs:
+            compute_slab(slab)
+    return gra_mag
 
 
-def set_gradient_magnitude(image, gramag_option):
+def set_gradient_magnitude(image, gramag_option, nr_threads=1):
     """Set gradient magnitude based on the command line flag.
 
     Parameters
@@ -307,6 +811,8 @@ def set_gradient_magnitude(image, gramag_option):
         First image, which is often the intensity image (eg. T1w).
     gramag_option : string
         A keyword string or a path to a nifti file.
+    nr_threads : integer
+        Number of threads used to compute the gradient magnitude.
 
     Returns
     -------
@@ -315,14 +821,16 @@ def set_gradient_magnitude(image, gramag_option):
 
     """
     if gramag_option not in cfg.gramag_options:
-        gra_mag_nii = load(gramag_option)
-        gra_mag = np.squeeze(gra_mag_nii.get_data())
-        gra_mag = truncate_range(gra_mag, percMin=cfg.perc_min,
-                                 percMax=cfg.perc_max)
-        gra_mag = scale_range(gra_mag, scale_factor=cfg.scale, delta=0.0001)
+        gra_mag = load_float32_data(load(gramag_option))
+        gra_mag, _, _, _ = preprocess_ima(gra_mag, percMin=cfg.perc_min,
+                                          percMax=cfg.perc_max,
+                                          scale_factor=cfg.scale,
+                                          delta=0.0001,
+                                          approx=cfg.perc_approx)
 
     else:
-        gra_mag = compute_gradient_magnitude(image, method=gramag_option)
+        gra_mag = compute_gradient_magnitude(image, method=gramag_option,
+                                             nr_threads=nr_threads)
     return gra_mag
 
 
@@ -475,10 +983,159 @@ def aniso_diff_3D(stack, niter=1, kappa=50, gamma=0.1, step=(1., 1., 1.),
     return stackout
 
 
+def get_nifti_extension(gzip_level):
+    """Return the nifti file extension for a gzip compression level."""
+    return '.nii.gz' if gzip_level > 0 else '.nii'
+
+
+class gzipBlockWriter:
+    """Write-only file object which compresses blocks in parallel.
+
+    Parameters
+    ----------
+    fileobj : file object
+        Opened output file.
+    gzip_level : int
+        Compression level between 1 (fastest) and 9 (smallest).
+    nr_threads : int
+        Number of blocks compressed at the same time.
+    block_size : int
+        Number of uncompressed bytes in each block.
+
+    Notes
+    -----
+    Every block is written as a separate gzip member. Concatenated members
+    are a valid gzip file that decompresses to the concatenated blocks. At
+    most nr_threads + 1 blocks are held in memory, however large the
+    written data is.
+
+    """
+
+    def __init__(self, fileobj, gzip_level=1, nr_threads=1,
+                 block_size=2**24):
+        """Open the compression thread pool."""
+        self.fileobj = fileobj
+        self.gzip_level = gzip_level
+        self.nr_threads = nr_threads
+        self.block_size = block_size
+        self.pool = ThreadPool(nr_threads)
+        self.pending = deque()
+        self.buffer = []
+        self.nrBuffered = 0
+        self.position = 0
+
+    def compressBlock(self, block):
+        """Compress one block as a gzip member."""
+        comp = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+        return comp.compress(block) + comp.flush()
+
+    def submitBlock(self):
+        """Compress the buffered bytes, write finished blocks in order."""
+        block = b''.join(self.buffer)
+        self.buffer, self.nrBuffered = [], 0
+        self.pending.append(self.pool.apply_async(self.compressBlock,
+                                                  (block,)))
+        while len(self.pending) > self.nr_threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def write(self, data):
+        """Buffer bytes, compressing every full block."""
+        data = memoryview(data)
+        start = 0
+        while start < len(data):
+            stop = start + self.block_size - self.nrBuffered
+            self.buffer.append(data[start:stop].tobytes())
+            self.nrBuffered += len(self.buffer[-1])
+            start = stop
+            if self.nrBuffered == self.block_size:
+                self.submitBlock()
+        self.position += len(data)
+
+    def read(self, size=-1):
+        """Not supported, but marks this as a file object for nibabel."""
+        raise IOError('Cannot read from a gzip block writer')
+
+    def tell(self):
+        """Return the number of uncompressed bytes written so far."""
+        return self.position
+
+    def seek(self, offset, whence=0):
+        """Only allow seeking to the current position."""
+        if (offset, whence) not in [(self.position, 0), (0, 1)]:
+            raise IOError('Cannot seek in a gzip block writer')
+        return self.position
+
+    def close(self):
+        """Compress the remaining bytes and wait for all blocks."""
+        try:
+            if self.nrBuffered > 0 or self.position == 0:
+                self.submitBlock()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+def write_gzip_blocks(data, filename, gzip_level=1, nr_threads=1,
+                      block_size=2**24):
+    """Write bytes as gzip file, compressing blocks in parallel.
+
+    Parameters
+    ----------
+    data : bytes
+        Data to be compressed.
+    filename : string
+        Output path.
+    gzip_level, nr_threads, block_size :
+        See gzipBlockWriter.
+
+    """
+    with open(filename, 'wb') as f:
+        writer = gzipBlockWriter(f, gzip_level=gzip_level,
+                                 nr_threads=nr_threads, block_size=block_size)
+        writer.write(data)
+        writer.close()
+
+
+def save_nifti(img, filename, gzip_level=1, nr_threads=1):
+    """Save a nifti image, compressed in parallel if the path ends with .gz.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        Image to be saved.
+    filename : string
+        Output path, ending with '.nii' or '.nii.gz'.
+    gzip_level : int
+        Compression level between 1 (fastest) and 9 (smallest).
+    nr_threads : int
+        Number of threads used for compression.
+
+    Notes
+    -----
+    nibabel writes the data slice by slice, so memory use is bounded by
+    the compression blocks, also for memory mapped data.
+
+    """
+    if not filename.endswith('.gz'):  # uncompressed fast path
+        save(img, filename)
+        return
+    # stream header and data through the block compressor
+    with open(filename, 'wb') as f:
+        writer = gzipBlockWriter(f, gzip_level=gzip_level,
+                                 nr_threads=nr_threads)
+        img.to_file_map(img.make_file_map({'image': writer,
+                                           'header': writer}))
+        writer.close()
+
+
 def export_gradient_magnitude_image(img, filename, affine):
     """Export computed gradient magnitude image as a nifti file."""
     basename = filename.split(os.extsep, 1)[0]
     out_img = Nifti1Image(img, affine=affine)
-    out_path = basename + '_gramag.nii.gz'
-    save(out_img, out_path)
+    out_path = basename + '_gramag' + get_nifti_extension(cfg.gzip_level)
+    save_nifti(out_img, out_path, gzip_level=cfg.gzip_level,
+               nr_threads=cfg.nr_threads)
     print('Gradient magnitude image exported in this path:\n' + out_path)